@@ -0,0 +1,154 @@
+from peak.util.extremes import Max
+import peak.events.trellis as trellis
+
+from chandler.core import AggregatedSet
+from chandler.event import Event
+from chandler.recurrence import Recurrence
+from chandler.time_services import timestamp
+
+__all__ = ('CalendarIndex', 'IntervalTree', 'event_span', 'overlaps')
+
+def overlaps(start, end, range_start, range_end):
+    """Does start..end overlap range_start..range_end?
+
+    Ranges include their start but not their end, except that a zero
+    length span overlaps a range it starts in.
+
+    """
+    if start == end:
+        return range_start <= start < range_end
+    return start < range_end and end > range_start
+
+def event_span(item):
+    """Return a (start, end, item, is_master) tuple for item, or None.
+
+    start and end are timestamps.  For a recurring master, the span
+    covers the whole series, so end will be Max if the series is
+    unbounded.
+
+    """
+    if not Event.installed_on(item):
+        return None
+    event = Event(item)
+    if event.start is None:
+        return None
+    start = timestamp(event.start)
+    duration = timestamp(event.end) - start
+    if not Recurrence.installed_on(item) or Recurrence(item).rruleset is None:
+        return start, start + duration, item, False
+
+    recurrence = Recurrence(item)
+    starts = [start]
+    starts.extend(timestamp(dt) for dt in recurrence.rdates)
+    for recipe in recurrence.modification_recipes.itervalues():
+        modified_start = recipe.changes.get((Event, 'base_start'))
+        if modified_start is not None:
+            starts.append(timestamp(modified_start))
+    if recurrence.frequency and recurrence.until is None:
+        end = Max
+    else:
+        if recurrence.frequency:
+            starts.append(timestamp(recurrence.until))
+        end = max(starts) + duration
+    return min(starts), end, item, True
+
+
+class IntervalTree(object):
+    """A centered interval tree of (start, end, ...) tuples.
+
+    The tree is immutable; build a new one when intervals change.
+
+    """
+
+    def __init__(self, intervals=()):
+        self._root = self._build(list(intervals))
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        starts = sorted(interval[0] for interval in intervals)
+        center = starts[len(starts) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        by_start = sorted(here, key=lambda interval: interval[0])
+        by_end = sorted(here, key=lambda interval: interval[1], reverse=True)
+        return (center, by_start, by_end,
+                self._build(left), self._build(right))
+
+    def overlapping(self, range_start, range_end):
+        """Yield intervals with start <= range_end and end >= range_start."""
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            center, by_start, by_end, left, right = node
+            if range_end < center:
+                for interval in by_start:
+                    if interval[0] > range_end:
+                        break
+                    yield interval
+                nodes.append(left)
+            elif range_start > center:
+                for interval in by_end:
+                    if interval[1] < range_start:
+                        break
+                    yield interval
+                nodes.append(right)
+            else:
+                for interval in by_start:
+                    yield interval
+                nodes.append(left)
+                nodes.append(right)
+
+
+class CalendarIndex(AggregatedSet):
+    """Index the events among a Set of items by time.
+
+    The values of the set are the event_span() tuples of the input items,
+    which are recalculated whenever the Event or Recurrence cells they
+    depend on change.  Recurring masters are indexed by the span of their
+    whole series, and expanded into Occurrences only when they overlap a
+    query.
+
+    """
+
+    def get_values(self, item):
+        span = event_span(item)
+        return () if span is None else (span,)
+
+    @trellis.compute
+    def _tree(self):
+        return IntervalTree(self)
+
+    def between(self, range_start, range_end):
+        """Return events and Occurrences overlapping a range, by start.
+
+        range_start and range_end are datetimes.
+
+        """
+        start_stamp = timestamp(range_start)
+        end_stamp = timestamp(range_end)
+        found = []
+        for start, end, item, is_master in self._tree.overlapping(start_stamp,
+                                                                  end_stamp):
+            if not is_master:
+                if overlaps(start, end, start_stamp, end_stamp):
+                    found.append((start, item))
+                continue
+            duration = Event(item).duration
+            occurrences = Recurrence(item).occurrences_between(
+                              range_start - duration, range_end)
+            for occurrence in occurrences:
+                event = Event(occurrence)
+                start = timestamp(event.start)
+                if overlaps(start, timestamp(event.end), start_stamp, end_stamp):
+                    found.append((start, occurrence))
+        found.sort(key=lambda pair: pair[0])
+        return [item for start, item in found]
@@ -4,8 +4,8 @@ from chandler.event import Event
 from chandler.starred import Starred
 from chandler.reminder import ReminderList
 import chandler.triage as triage
-from chandler.time_services import (TimeZone, is_past, timestamp, fromtimestamp,
-                                    getNow)
+from chandler.time_services import (TimeZone, Today, DateFormatter, is_past,
+                                    timestamp, fromtimestamp, getNow)
 import chandler.core as core
 import chandler.wxui.image as image
 from chandler.i18n import _
@@ -13,6 +13,15 @@ from datetime import datetime, timedelta
 
 TRIAGE_HOOK  = plugins.Hook('chandler.dashboard.triage')
 
+# Triage positions are timestamps, so they're well within this many seconds
+# of the epoch; multiplying a section by it leaves room for any position,
+# while keeping the packed value exact to within a few milliseconds.
+TRIAGE_SECTION_SCALE = float(2 ** 37)
+
+def pack_triage_key(section, position):
+    """Fold a triage section and position into one sortable float."""
+    return section * TRIAGE_SECTION_SCALE + position
+
 class AppDashboardEntry(addons.AddOn, trellis.Component):
     @trellis.make
     def subject(self):
@@ -38,6 +47,10 @@ class AppDashboardEntry(addons.AddOn, trellis.Component):
     def triage_section(self):
         return triage.TriagePosition(self._item).triage_section
 
+    @trellis.compute
+    def triage_sort_key(self):
+        return pack_triage_key(self.triage_section, self.triage_position)
+
     @trellis.compute
     def is_event(self):
         return Event.installed_on(self._item)
@@ -101,17 +114,19 @@ class AppDashboardEntry(addons.AddOn, trellis.Component):
             return fromtimestamp(self._item.created), False
 
     @trellis.compute
-    def display_date(self):
+    def when_sort_key(self):
         when, is_day = self._when_and_is_day
+        # timestamps are whole seconds, so this sorts is_day entries after
+        # others at the same time, like sorting by _when_and_is_day would
+        return timestamp(when) + (0.5 if is_day else 0.0)
 
-        when = when.astimezone(TimeZone.default)
-        when_date = when.date()
+    @trellis.compute
+    def display_date(self):
+        when, is_day = self._when_and_is_day
 
-        # [@@@] Real date format support rather than strftime
-        time_part = when.strftime("%X") if not is_day else ""
+        date_part, time_part = DateFormatter.format(when, is_day)
 
-        # [@@@] Probably time_services should offer a today cell here
-        since_today = (when_date - getNow().date()).days
+        since_today = Today.days_from_today(timestamp(when))
         if since_today == -1:
             return _(u"Yesterday"), time_part
         elif since_today == 0:
@@ -119,7 +134,7 @@ class AppDashboardEntry(addons.AddOn, trellis.Component):
         elif since_today == 1:
             return _(u"Tomorrow"), time_part
         else:
-            return when.strftime("%x"), time_part
+            return date_part, time_part
 
     @trellis.compute
     def reminder_scheduled(self):
@@ -145,7 +160,8 @@ class AppDashboardEntry(addons.AddOn, trellis.Component):
             return ""
 
 
-plugins.Hook('chandler.domain.dashboard_entry_addon').register(AppDashboardEntry)
+core.register_hook(plugins.Hook('chandler.domain.dashboard_entry_addon'),
+                   AppDashboardEntry)
 
 class AppEntryAggregate(core.AggregatedSet):
     """
@@ -179,7 +195,7 @@ class TriageColumn(AppColumn):
     app_attr = trellis.attr('triage_status')
 
     def sort_key(self, entry):
-        return entry.triage_section, entry.triage_position
+        return entry.triage_sort_key
 
     _triage_values = None
 
@@ -194,55 +210,63 @@ class TriageColumn(AppColumn):
             type(self)._triage_values = tuple(triage_values)
         return self._triage_values
 
+    _next_triage_values = None
+
+    @property
+    def next_triage_values(self):
+        """Map each triage value to the one after it, wrapping around."""
+        if self._next_triage_values is None:
+            values = [value for value, presentation in self.triage_values]
+            type(self)._next_triage_values = dict(zip(values,
+                                                      values[1:] + values[:1]))
+        return self._next_triage_values
+
     @trellis.modifier
     def action(self, selection):
+        first_value = self.triage_values[0][0]
+        items_by_value = {}
         for app_entry in selection:
-            old_value = app_entry.triage_section
-            for index, value in enumerate(self.triage_values):
-                if value[0] == old_value:
-                    if index + 1 < len(self.triage_values):
-                        new_value = self.triage_values[index+1][0]
-                    else:
-                        new_value = self.triage_values[0][0]
-                    break
-            else:
-                new_value = self.triage_values[0][0]
-            triage.Triage(app_entry._item).manual = new_value
+            new_value = self.next_triage_values.get(app_entry.triage_section,
+                                                    first_value)
+            items_by_value.setdefault(new_value, []).append(app_entry._item)
+        for new_value, items in items_by_value.iteritems():
+            triage.Triage.bulk_set_manual(items, new_value)
 
 class ReminderColumn(AppColumn):
     label = trellis.attr('(( ))')
     app_attr = trellis.attr('event_reminder_combined')
 
     def sort_key(self, entry):
-        return entry.triage_section, entry.triage_position
+        return entry.triage_sort_key
 
     _triage_values = None
 
     @trellis.modifier
     def action(self, selection):
+        remove_from, add_to = [], []
         for app_entry in selection:
-            old_value = app_entry.event_reminder_combined
-            rlist = ReminderList(app_entry._item)
-            if old_value == 'reminder':
-                rlist.remove_all_reminders()
+            if app_entry.event_reminder_combined == 'reminder':
+                remove_from.append(app_entry._item)
             else:
-                trigger = getNow()
-                if trigger.hour < 17:
-                    hour = 17
-                else:
-                    trigger += timedelta(days=1)
-                    hour = 8
-                trigger = trigger.replace(hour=hour, minute=0, second=0,
-                                          microsecond=0)
-                reminder = rlist.add_reminder()
-                reminder.fixed_trigger = trigger
+                add_to.append(app_entry._item)
+
+        ReminderList.bulk_remove_all_reminders(remove_from)
+        if add_to:
+            trigger = getNow()
+            if trigger.hour < 17:
+                hour = 17
+            else:
+                trigger += timedelta(days=1)
+                hour = 8
+            trigger = trigger.replace(hour=hour, minute=0, second=0,
+                                      microsecond=0)
+            ReminderList.bulk_add_reminder(add_to, fixed_trigger=trigger)
 
 
 class StarredColumn(AppColumn):
     @staticmethod
     def action(selection):
-        for app_entry in selection:
-            app_entry.toggle_star()
+        Starred.bulk_toggle([app_entry._item for app_entry in selection])
 
 
 @trellis.modifier
@@ -274,7 +298,7 @@ class Dashboard(core.Table):
     def date_column(self):
         return AppColumn(scope=self, label='Date', app_attr='display_date',
                          hints={'width':220, 'type':'DashboardDate'},
-                         sort_key=lambda value:value._when_and_is_day)
+                         sort_key=lambda value:value.when_sort_key)
 
     @trellis.maintain
     def triage_column(self):
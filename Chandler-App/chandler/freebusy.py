@@ -0,0 +1,163 @@
+import peak.events.trellis as trellis
+from peak.util import addons
+
+from chandler.core import AggregatedSet
+from chandler.event import Event
+from chandler.recurrence import Recurrence
+from chandler.calendar_index import IntervalTree, event_span, overlaps
+from chandler.time_services import timestamp, fromtimestamp
+
+__all__ = ('BUSY', 'TENTATIVE', 'FREE', 'FreeBusy', 'free_busy',
+           'merge_periods')
+
+BUSY = 'busy'
+TENTATIVE = 'tentative'
+FREE = 'free'
+
+# Event transparency -> free/busy status; 'fyi' events don't make anyone busy
+_statuses = {'confirmed' : BUSY, 'tentative' : TENTATIVE}
+
+def busy_span(item):
+    """Return a (start, end, item, is_master, status) tuple, or None.
+
+    Recurring masters are always included (with the master's status),
+    since individual Occurrences may be modified to be busy.
+
+    """
+    span = event_span(item)
+    if span is None:
+        return None
+    status = _statuses.get(Event(item).transparency)
+    if status is None and not span[3]:
+        return None
+    return span + (status,)
+
+def merge_periods(spans, range_start, range_end):
+    """Merge (start, end, status) spans into free/busy periods.
+
+    Returns a list of (start, end, status) tuples exactly covering
+    range_start..range_end, where overlapping busy time wins over
+    tentative, and tentative over free.
+
+    """
+    edges = []
+    for start, end, status in spans:
+        start = max(start, range_start)
+        end = min(end, range_end)
+        if start < end:
+            edges.append((start, 1, status))
+            edges.append((end, -1, status))
+    edges.sort()
+
+    counts = {BUSY : 0, TENTATIVE : 0}
+    periods = []
+    current, current_start = FREE, range_start
+    i = 0
+    while i < len(edges):
+        when = edges[i][0]
+        while i < len(edges) and edges[i][0] == when:
+            counts[edges[i][2]] += edges[i][1]
+            i += 1
+        if counts[BUSY]:
+            status = BUSY
+        elif counts[TENTATIVE]:
+            status = TENTATIVE
+        else:
+            status = FREE
+        if status != current:
+            if when > current_start:
+                periods.append((current_start, when, current))
+            current, current_start = status, when
+    if current_start < range_end:
+        periods.append((current_start, range_end, current))
+    return periods
+
+
+class _BusySpans(AggregatedSet):
+    def get_values(self, item):
+        span = busy_span(item)
+        return () if span is None else (span,)
+
+
+class FreeBusy(addons.AddOn, trellis.Component):
+    """Free/busy periods for the items in a collection.
+
+    Periods are remembered for each window asked for, until one of the
+    collection's events changes.
+
+    """
+    @trellis.make
+    def subject(self):
+        return None
+
+    def __init__(self, subject, **kw):
+        kw.update(subject=subject)
+        trellis.Component.__init__(self, **kw)
+
+    @trellis.make
+    def _spans(self):
+        return _BusySpans(input=self.subject.items)
+
+    @trellis.compute
+    def _tree(self):
+        return IntervalTree(self._spans)
+
+    @trellis.compute
+    def _cache(self):
+        self._tree # forget every window whenever a span changes
+        return {}
+
+    def busy_between(self, start, end):
+        """Yield (start, end, status, item) for busy time from start to end.
+
+        start and end are timestamps.  Recurring masters are expanded
+        into Occurrences here, and only when they overlap start..end.
+
+        """
+        for span_start, span_end, item, is_master, status in \
+                self._tree.overlapping(start, end):
+            if not is_master:
+                if overlaps(span_start, span_end, start, end):
+                    yield span_start, span_end, status, item
+                continue
+            range_start = fromtimestamp(start) - Event(item).duration
+            occurrences = Recurrence(item).occurrences_between(range_start,
+                                                               fromtimestamp(end))
+            for occurrence in occurrences:
+                event = Event(occurrence)
+                status = _statuses.get(event.transparency)
+                if status is None:
+                    continue
+                occurrence_start = timestamp(event.start)
+                occurrence_end = timestamp(event.end)
+                if overlaps(occurrence_start, occurrence_end, start, end):
+                    yield occurrence_start, occurrence_end, status, occurrence
+
+    def periods(self, range_start, range_end):
+        """Return (start, end, status) periods covering a range of datetimes."""
+        key = timestamp(range_start), timestamp(range_end)
+        cache = self._cache
+        if key not in cache:
+            cache[key] = merge_periods(
+                ((start, end, status) for start, end, status, item
+                                      in self.busy_between(*key)),
+                *key
+            )
+        return [(fromtimestamp(start), fromtimestamp(end), status)
+                for start, end, status in cache[key]]
+
+
+def free_busy(collections, range_start, range_end):
+    """Return (start, end, status) periods for several collections.
+
+    Items in more than one collection are only counted once.
+
+    """
+    start, end = timestamp(range_start), timestamp(range_end)
+    spans = {}
+    for collection in collections:
+        for span in FreeBusy(collection).busy_between(start, end):
+            spans[span[3], span[0]] = span[:3]
+    return [(fromtimestamp(period_start), fromtimestamp(period_end), status)
+            for period_start, period_end, status
+            in merge_periods(spans.itervalues(), start, end)]
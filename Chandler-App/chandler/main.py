@@ -1,3 +1,5 @@
+from __future__ import with_statement
+
 import optparse
 import peak.events.trellis as trellis
 import peak.context as context
@@ -6,8 +8,10 @@ from chandler import runtime, core, keyword
 import chandler.sidebar as sidebar
 import chandler.dashboard as dashboard
 from os.path import isfile, expanduser
+from shutil import copyfile
 
 EIM_PERSISTENCE_FILE = expanduser("~/chandler2.chex.gz")
+EIM_JOURNAL_FILE = EIM_PERSISTENCE_FILE + ".journal"
 
 class ChandlerApplication(runtime.Application):
     """The Chandler Application"""
@@ -16,6 +20,23 @@ class ChandlerApplication(runtime.Application):
 
     top_level = trellis.make(trellis.Set)
 
+    @trellis.maintain
+    def _entries_by_collection(self):
+        """Map each collection in sidebar_entries to its SidebarEntry.
+
+        Every entry's collection is read, so the map is rebuilt when one is
+        reassigned, as well as when entries are added or removed.  If two
+        entries share a collection, the one sorted first wins.
+        """
+        entries = {}
+        for entry in sorted(self.sidebar_entries, reverse=True):
+            entries[entry.collection] = entry
+        return entries
+
+    def sidebar_entry_for(self, collection):
+        """Return the SidebarEntry for collection, or None."""
+        return self._entries_by_collection.get(collection)
+
 def useChandlerApplication():
     runtime.Application <<= ChandlerApplication
 
@@ -32,47 +53,119 @@ class ChandlerFrame(core.Frame):
     def dashboard(self):
         return dashboard.Dashboard(scope=self, model=dashboard.AppEntryAggregate(input=self.sidebar.filtered_items))
 
+class Persistence(context.Service):
+    """Save the domain model as a snapshot, plus a journal of changes.
+
+    While journaling, the changes made by each transaction are appended
+    to the journal; the snapshot is only rewritten (and the journal
+    emptied) on quit, once the journal has compact_after entries.
+    """
+
+    journaling = False
+    compact_after = 1000
+
+    def __init__(self):
+        from chandler.sharing.journal import Journal
+        self.journal = Journal(EIM_PERSISTENCE_FILE, EIM_JOURNAL_FILE,
+                               gzip=True)
+        self.tracker = None
+
+    def load(self):
+        """Load the snapshot and journal, returning False if there are none."""
+        if not self.journal.exists():
+            return False
+        self.journal.replay()
+        return True
+
+    def start_tracking(self):
+        from chandler.sharing.journal import ChangeTracker
+        collections = core.AggregatedSet(
+                          input=ChandlerApplication.sidebar_entries,
+                          get_values=lambda entry: (entry.collection,))
+        self.tracker = ChangeTracker(collections=collections,
+                                     journal=self.journal)
+
+    def save(self):
+        if self.tracker is not None:
+            self.journal.append(self.tracker.take_changes())
+        if (self.tracker is None or not isfile(EIM_PERSISTENCE_FILE)
+            or self.journal.entries >= self.compact_after):
+            self.compact()
+
+    def compact(self):
+        if isfile(EIM_PERSISTENCE_FILE):
+            copyfile(EIM_PERSISTENCE_FILE, EIM_PERSISTENCE_FILE + '~')
+        # dump() sorts the plan by alias, so chandler.sharing.delta can
+        # merge the snapshot with another one
+        self.journal.compact(export_plan())
+
 def load_domain():
     """Load up the domain model for ChandlerApplication"""
-    if not isfile(EIM_PERSISTENCE_FILE):
+    # Item add-ons are created as they're used, not for every loaded item
+    with core.LazyAddOns.lazily():
+        loaded = Persistence.load()
+    if not loaded:
         ChandlerApplication.sidebar_entries = trellis.Set(
                 sidebar.SidebarEntry(collection=keyword.Keyword(name))
                 for name in (u"Home", u"Work")
             )
-    else:
-        from chandler.sharing import dumpreload
-        dumpreload.reload(EIM_PERSISTENCE_FILE, gzip=True)
 
 def load_interaction(app):
     load_domain()
+    if Persistence.journaling:
+        Persistence.start_tracking()
 
     # IM-specific stuff here
     app.top_level.add(ChandlerFrame(model=app.sidebar_entries,
                                     label=u'Chandler2 Demo'))
 
+def export_plan():
+    """Yield the aliases of sidebar collections and their items, for dump().
+
+    Each item is only yielded once, even if it's in several collections.
+    EIM is added to everything that doesn't have it yet in a single
+    modifier, before the first alias is yielded.  Collections and regular
+    items come first, then any Occurrences, so masters are yielded before
+    their modifications.  Pass ordered=True to dump() to keep this order;
+    snapshots that chandler.sharing.delta compares need dump()'s sort.
+
+    """
+    from chandler.sharing import eim
+    from chandler.sharing.translator import getAliasForItem
+    from chandler.recurrence import Occurrence
+    collections = [entry.collection
+                   for entry in ChandlerApplication.sidebar_entries]
+    items, occurrences, seen = [], [], set(collections)
+    for collection in collections:
+        for item in collection.items:
+            if item not in seen:
+                seen.add(item)
+                if isinstance(item, Occurrence):
+                    occurrences.append(item)
+                else:
+                    items.append(item)
+
+    missing = [item for item in collections + items
+               if not eim.EIM.installed_on(item)]
+    if missing:
+        eim.add_eim(missing)
+
+    for collection in collections:
+        eim_collection = eim.EIM(collection)
+        yield eim_collection.well_known_name or eim_collection.uuid
+    for item in items:
+        yield eim.EIM(item).uuid
+    for occurrence in occurrences:
+        yield getAliasForItem(occurrence)
+
 def uuids_to_export():
     """Add the EIM extension to sidebar_entries, return uuids to export."""
-    from chandler.sharing import eim
-    uuids = []
-    for entry in ChandlerApplication.sidebar_entries:
-        eim_entry = eim.EIM(entry.collection)
-        if not eim.EIM.installed_on(entry.collection):
-            eim_entry.add()
-        uuids.append(eim_entry.well_known_name or eim_entry.uuid)
-        for item in entry.collection.items:
-            # this exports items in the collections, but not modifications
-            eim_item = eim.EIM(item)
-            if not eim.EIM.installed_on(eim_item):
-                eim_item.add()
-            uuids.append(eim_item.uuid)
-    return uuids
+    return list(export_plan())
 
 def save_all(*args):
-    from chandler.sharing import dumpreload
-    if isfile(EIM_PERSISTENCE_FILE):
-        dumpreload.overwrite_rename(EIM_PERSISTENCE_FILE,
-                                    EIM_PERSISTENCE_FILE + '~')
-    dumpreload.dump_to_path(EIM_PERSISTENCE_FILE, uuids_to_export(), gzip=True)
+    from chandler.sharing.autosave import AutoSave
+    AutoSave.stop()
+    Persistence.save()
 
 def _headless(app):
     banner = """
@@ -97,10 +190,20 @@ def main():
     parser = optparse.OptionParser()
     parser.add_option("-H", "--headless", action="store_true", dest="headless")
     parser.add_option("-s", "--save",     action="store_true", dest="save",
-                      help="Save data on quit to %s" % EIM_PERSISTENCE_FILE)
+                      help="Save data to %s" % EIM_PERSISTENCE_FILE)
+    parser.add_option("--autosave-interval", type="float", default=30.0,
+                      dest="autosave_interval",
+                      help="Save after this many seconds without changes")
+    parser.add_option("--autosave-latency", type="float", default=300.0,
+                      dest="autosave_latency",
+                      help="Save at most this many seconds after a change")
 
     options, arguments = parser.parse_args()
     if options.save:
+        from chandler.sharing.autosave import AutoSave
+        Persistence.journaling = True
+        AutoSave.interval = options.autosave_interval
+        AutoSave.max_latency = options.autosave_latency
         plugins.Hook('chandler.shutdown.app').register(save_all)
 
     if options.headless:
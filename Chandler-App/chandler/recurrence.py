@@ -1,6 +1,10 @@
+from __future__ import with_statement
+
 from datetime import datetime, timedelta
+import heapq
+import weakref
 import peak.events.trellis as trellis
-from peak.util import plugins
+from peak.util import addons, plugins
 from dateutil.rrule import rrule, rruleset
 import dateutil.rrule
 
@@ -25,6 +29,8 @@ def to_hashable(dt):
     else:
         return timestamp(dt)
 
+MAX_CACHED_INSTANCES = 1000
+
 days = "MO TU WE TH FR SA SU".split()
 day_to_int = dict((v, k) for k, v in enumerate(days))
 
@@ -47,6 +53,204 @@ def to_dateutil_byweekday(byday):
         l.append(dateutil.rrule.weekdays[day_to_int[w]](n))
     return l
 
+def instance_function(start, frequency, byday=''):
+    """Return a function mapping n to the n-th (from 0) instance of a rule.
+
+    The returned function returns None if the instance is too far in the
+    future to represent.  Only simple rules (DAILY, WEEKLY, possibly with
+    a plain BYDAY, and MONTHLY or YEARLY where every period has a
+    matching date) have closed forms, for anything else return None.
+
+    """
+    if start is None or not frequency:
+        return None
+    frequency = frequency.upper()
+
+    if byday:
+        if frequency not in ('DAILY', 'WEEKLY'):
+            return None
+        weekdays = []
+        for wday in byday.split(','):
+            if wday not in day_to_int:
+                return None
+            weekdays.append(day_to_int[wday])
+        weekdays = sorted(set(weekdays))
+        week_start = start - timedelta(days=start.weekday())
+        first_week = [w for w in weekdays if w >= start.weekday()]
+        def nth(n):
+            if n < len(first_week):
+                return week_start + timedelta(days=first_week[n])
+            weeks, index = divmod(n - len(first_week), len(weekdays))
+            return week_start + timedelta(days=7 * (weeks + 1) + weekdays[index])
+    elif frequency in ('DAILY', 'WEEKLY'):
+        step = 1 if frequency == 'DAILY' else 7
+        def nth(n):
+            return start + timedelta(days=step * n)
+    elif frequency == 'MONTHLY' and start.day <= 28:
+        def nth(n):
+            years, month = divmod(start.month - 1 + n, 12)
+            return start.replace(year=start.year + years, month=month + 1)
+    elif frequency == 'YEARLY' and (start.month, start.day) != (2, 29):
+        def nth(n):
+            return start.replace(year=start.year + n)
+    else:
+        return None
+
+    def instance(n):
+        try:
+            return nth(n)
+        except (OverflowError, ValueError):
+            return None
+    return instance
+
+def count_until(nth, until):
+    """Return how many instances of nth are on or before until."""
+    def is_after(n):
+        dt = nth(n)
+        return dt is None or dt > until
+
+    if is_after(0):
+        return 0
+    # gallop forward, then bisect; nth(low) <= until < nth(high)
+    low, high = 0, 1
+    while not is_after(high):
+        low, high = high, 2 * high
+    while high - low > 1:
+        middle = (low + high) // 2
+        if is_after(middle):
+            high = middle
+        else:
+            low = middle
+    return low + 1
+
+def _undo(func, *args):
+    """Undo with func(*args) if the current transaction is rolled back"""
+    if trellis.ctrl.active:
+        trellis.on_undo(func, *args)
+
+def _has_add_on_state(occurrence):
+    """Has anything been set on occurrence's add-ons, not just inherited?
+
+    Settable add-on cells, like manual triage, pinned positions and
+    reminders, belong to the Occurrence itself.  If it's evicted and
+    created again, they're back to their defaults.
+
+    """
+    for add_on in addons.addons_for(occurrence).values():
+        if not isinstance(add_on, ItemAddOn):
+            continue
+        cls = type(add_on)
+        for name, cell in trellis.Cells(add_on).items():
+            attr = getattr(cls, name, None)
+            if (name == '_item' or not isinstance(attr, trellis.CellAttribute)
+                or attr.rule is not None):
+                continue
+            value = cell.value
+            if attr.make is None:
+                if value != attr.initial_value(add_on):
+                    return True
+            elif (isinstance(value, (trellis.List, trellis.Dict, trellis.Set))
+                  and len(value)):
+                return True
+    return False
+
+class OccurrenceCache(object):
+    """Map hashable recurrence-ids to Occurrences, using bounded memory.
+
+    The ``size`` most recently used Occurrences are kept, along with any
+    Occurrence that is_pinned (e.g. modified, triaged, or with reminders).
+    Evicted Occurrences are still returned while something else refers
+    to them (a DashboardEntry, say), so an Occurrence's identity never
+    changes while it's in use.
+
+    The cache is used from inside rules, so its changes are undone if the
+    transaction is rolled back, and is_pinned shouldn't read cells.
+
+    """
+    size = 256
+
+    def __init__(self, is_pinned, size=None):
+        self.is_pinned = is_pinned
+        if size is not None:
+            self.size = size
+        self._recent = {}   # recurrence-id -> (tick, occurrence)
+        self._queue = []    # heap of (tick, recurrence-id), may be stale
+        self._pinned = {}
+        self._referenced = weakref.WeakValueDictionary()
+        self._tick = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._recent) + len(self._pinned)
+
+    def get(self, recurrence_id):
+        occurrence = self._pinned.get(recurrence_id)
+        if occurrence is not None and not self.is_pinned(recurrence_id, occurrence):
+            self._unpin(recurrence_id)
+        if occurrence is None:
+            occurrence = self._recent.get(recurrence_id, (None, None))[1]
+        if occurrence is None:
+            occurrence = self._referenced.get(recurrence_id)
+        if occurrence is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if recurrence_id not in self._pinned:
+                self._touch(recurrence_id, occurrence)
+        return occurrence
+
+    def add(self, recurrence_id, occurrence):
+        self._referenced[recurrence_id] = occurrence
+        _undo(self._referenced.pop, recurrence_id, None)
+        self._touch(recurrence_id, occurrence)
+
+    def _set_recent(self, recurrence_id, entry):
+        old = self._recent.get(recurrence_id)
+        if old is None:
+            _undo(self._recent.pop, recurrence_id, None)
+        else:
+            _undo(self._recent.__setitem__, recurrence_id, old)
+        if entry is None:
+            del self._recent[recurrence_id]
+        else:
+            self._recent[recurrence_id] = entry
+
+    def _unpin(self, recurrence_id):
+        _undo(self._pinned.__setitem__, recurrence_id,
+              self._pinned.pop(recurrence_id))
+
+    def _touch(self, recurrence_id, occurrence):
+        self._tick += 1
+        self._set_recent(recurrence_id, (self._tick, occurrence))
+        # an undone push just leaves a stale queue entry, which is harmless
+        heapq.heappush(self._queue, (self._tick, recurrence_id))
+        if len(self._recent) > self.size:
+            self._evict()
+        elif len(self._queue) > 4 * self.size:
+            # drop stale queue entries
+            _undo(setattr, self, '_queue', self._queue)
+            self._queue = [(tick, key) for key, (tick, occ)
+                           in self._recent.iteritems()]
+            heapq.heapify(self._queue)
+
+    def _evict(self):
+        while len(self._recent) > self.size:
+            tick, recurrence_id = heapq.heappop(self._queue)
+            _undo(heapq.heappush, self._queue, (tick, recurrence_id))
+            entry = self._recent.get(recurrence_id)
+            if entry is None or entry[0] != tick:
+                continue
+            self._set_recent(recurrence_id, None)
+            if self.is_pinned(recurrence_id, entry[1]):
+                self._pinned[recurrence_id] = entry[1]
+                _undo(self._pinned.pop, recurrence_id, None)
+            else:
+                self.evictions += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self))
+
 class Recurrence(Extension):
     trellis.attrs(
         frequency=None,
@@ -62,10 +266,13 @@ class Recurrence(Extension):
         _recurrence_dashboard_entries=trellis.Dict,
         rdates=trellis.Set,
         exdates=trellis.Set,
-        _occurrence_cache=dict,
         _pre_modification_cells=dict
     )
 
+    _occurrence_cache = trellis.make(
+        lambda self: OccurrenceCache(self._is_pinned)
+    )
+
     @trellis.compute
     def start(self):
         if not self.start_extension.installed_on(self.item):
@@ -77,7 +284,41 @@ class Recurrence(Extension):
         extension = self.start_extension(item)
         return getattr(extension, self.start_extension_cellname)
 
-    def build_rrule(self, count=None, until=None):
+    # (start key, table) where the table maps (add-on class or None, name)
+    # to the master's cell for that name
+    _inherited = None
+
+    def _inherited_cells(self):
+        """Return the table of the master's cells that Occurrences share.
+
+        It's filled in as Occurrences look up unmodified values.  The start
+        cell maps to None, since each Occurrence's start is its
+        recurrence-id, so the table is thrown away and started again when
+        start_extension or recurrence_id_override changes.
+
+        """
+        start_key = self.start_extension, self.recurrence_id_override
+        if self._inherited is None or self._inherited[0] != start_key:
+            _undo(setattr, self, '_inherited', self._inherited)
+            self._inherited = start_key, {start_key: None}
+        return self._inherited[1]
+
+    def inherited_value(self, occurrence, key):
+        """Return the master's value for an unmodified Occurrence attribute."""
+        cells = self._inherited_cells()
+        try:
+            cell = cells[key]
+        except KeyError:
+            cls, name = key
+            master = self.item if cls is None else cls(self.item)
+            getattr(master, name) # make sure the cell exists
+            cell = cells[key] = trellis.Cells(master)[name]
+            _undo(cells.pop, key, None)
+        if cell is None:
+            return occurrence.recurrence_id
+        return cell.value
+
+    def build_rrule(self, count=None, until=None, cache=False):
         """Return a dateutil rrule based on self.
 
         The time-limit for the series can be overridden by setting
@@ -87,7 +328,7 @@ class Recurrence(Extension):
         kwds = dict(dtstart=self.start,
                     freq=to_dateutil_frequency(self.frequency),
                     byweekday=to_dateutil_byweekday(self.byday),
-                    cache=True)
+                    cache=cache)
 
         if count is not None:
             kwds['count'] = count
@@ -108,6 +349,9 @@ class Recurrence(Extension):
         elif not self.frequency:
             pass
         else:
+            nth = instance_function(self.start, self.frequency, self.byday)
+            if nth is not None and self.count > 0:
+                return nth(self.count - 1)
             rule = self.build_rrule(count=self.count)
             return rule[-1]
 
@@ -119,6 +363,9 @@ class Recurrence(Extension):
         elif self.until is None:
             return None
         else:
+            nth = instance_function(self.start, self.frequency, self.byday)
+            if nth is not None:
+                return count_until(nth, self.until)
             rule = self.build_rrule(until=self.until)
             return rule.count()
 
@@ -126,9 +373,11 @@ class Recurrence(Extension):
     def rruleset(self):
         if self.start is None:
             return None
-        rrs = rruleset(cache=True)
+        # only cache instances of short, finite series
+        cache = self.count is not None and self.count <= MAX_CACHED_INSTANCES
+        rrs = rruleset(cache=cache)
         if self.frequency is not None:
-            rrs.rrule(self.build_rrule())
+            rrs.rrule(self.build_rrule(cache=cache))
         elif not self.rdates:
             # no rules or rdates, nothing to do
             return None
@@ -142,11 +391,97 @@ class Recurrence(Extension):
         """Return Occurrence for recurrence_id, cache it for later."""
         recurrence_id = to_hashable(recurrence_id)
         occ = self._occurrence_cache.get(recurrence_id)
-        if not occ:
-            occ = Occurrence(self.item, recurrence_id)
-            self._occurrence_cache[recurrence_id] = occ
+        if occ is None:
+            with LazyAddOns.lazily():
+                occ = Occurrence(self.item, recurrence_id)
+            self._occurrence_cache.add(recurrence_id, occ)
         return occ
 
+    def _is_pinned(self, recurrence_id, occurrence):
+        """Should occurrence never be evicted?
+
+        Occurrences with dashboard entries don't need pinning, their
+        DashboardEntry keeps them alive.  Nothing is read as a dependency,
+        so whatever rule caused an eviction doesn't come to depend on it.
+
+        """
+        return untracked(self._has_state, recurrence_id, occurrence)
+
+    def _has_state(self, recurrence_id, occurrence):
+        return (recurrence_id in self.modification_recipes or
+                recurrence_id in self.triaged_recurrence_ids or
+                _has_add_on_state(occurrence))
+
+    def _triage_status(self, recurrence_id, now=None):
+        """Return the calculated triage status for recurrence_id.
+
+        Avoids creating an Occurrence for past recurrence-ids that
+        occurrence_triage would simply mark DONE.  Future ones aren't DONE
+        yet, even before triaged_done_before.
+
+        """
+        hashable = to_hashable(recurrence_id)
+        done_before = self.triaged_done_before
+        if now is None:
+            now = getNow()
+        if (done_before is not None and recurrence_id <= min(done_before, now)
+            and hashable not in self.triaged_recurrence_ids and
+            hashable not in self.modification_recipes):
+            return DONE
+        return Triage(self.get_occurrence(recurrence_id)).calculated
+
+    def _dashboard_window(self, now):
+        """Yield the recurrence-ids dashboard_recurrence_ids has to look at.
+
+        Untriaged, unmodified recurrence-ids on or before triaged_done_before
+        (and now) are DONE, so only the last of them matters and the walk
+        starts there.  Without triaged_done_before past recurrence-ids are
+        NOW, so they're all on the dashboard and the walk starts at the
+        beginning.  Simple rules jump to the window's first instance, rdates
+        and exdates mean rruleset has to be walked instead.
+
+        """
+        def is_exception(recurrence_id):
+            hashable = to_hashable(recurrence_id)
+            return (hashable in self.triaged_recurrence_ids or
+                    hashable in self.modification_recipes)
+
+        done_before = self.triaged_done_before
+        nth = None
+        if not self.rdates and not self.exdates:
+            nth = instance_function(self.start, self.frequency, self.byday)
+
+        if nth is None:
+            start = None
+            if done_before is not None:
+                start = self.rruleset.before(min(done_before, now), inc=True)
+                while start is not None and is_exception(start):
+                    start = self.rruleset.before(start)
+            for recurrence_id in self.rruleset:
+                if start is None or recurrence_id >= start:
+                    yield recurrence_id
+            return
+
+        last = None
+        if self.count is not None:
+            last = self.count - 1
+        elif self.until is not None:
+            last = count_until(nth, self.until) - 1
+        index = 0
+        if done_before is not None:
+            index = count_until(nth, min(done_before, now)) - 1
+            if last is not None:
+                index = min(index, last)
+            while index > 0 and is_exception(nth(index)):
+                index -= 1
+            index = max(index, 0)
+        while last is None or index <= last:
+            recurrence_id = nth(index)
+            if recurrence_id is None:
+                break
+            yield recurrence_id
+            index += 1
+
     @trellis.maintain
     def dashboard_recurrence_ids(self):
         """The set of recurrence_ids which should have DashboardEntries.
@@ -158,17 +493,19 @@ class Recurrence(Extension):
         if old_set is None:
             old_set = frozenset()
 
-        if not self in self.item.extensions or not self.start or not self.rruleset:
+        if not Recurrence.installed_on(self.item) or not self.start or not self.rruleset:
             new_set = frozenset()
         else:
             now_dt = getNow()
             past_done = None
             future_later = None
             new_set = set()
-            for recurrence_id in self.rruleset:
-                # XXX inefficient, creating an Occurrence for every past recurrence-id,
-                # probably should be optimized by walking backwards from triaged_done_before
-                triage = Triage(self.get_occurrence(recurrence_id)).calculated
+
+            # Past recurrence-ids up to triaged_done_before are found to be
+            # DONE without creating Occurrences, and all but the last of
+            # them aren't walked at all.
+            for recurrence_id in self._dashboard_window(now_dt):
+                triage = self._triage_status(recurrence_id, now_dt)
                 if triage not in (LATER, DONE):
                     new_set.add(to_hashable(recurrence_id))
                 else:
@@ -248,12 +585,7 @@ class Occurrence(Item):
         recipe = self.modification_recipe
         if recipe and key in recipe.changes:
             return recipe.changes[key]
-        elif (cls  == Recurrence(self.master).start_extension and
-              name == Recurrence(self.master).recurrence_id_override):
-            return self.recurrence_id
-        else:
-            master = self.master if cls is None else cls(self.master)
-            return getattr(master, name)
+        return self._master_recurrence.inherited_value(self, key)
 
     @trellis.compute
     def created(self):
@@ -263,6 +595,14 @@ class Occurrence(Item):
     def _extension_types(self):
         return frozenset(t for t in self.master._extension_types if t is not Recurrence)
 
+    @trellis.compute
+    def extensions(self):
+        return frozenset(t(self) for t in self._extension_types)
+
+    def has_extension(self, extension_type):
+        return (extension_type is not Recurrence and
+                self.master.has_extension(extension_type))
+
     @trellis.compute
     def collections(self):
         return self.master.collections
@@ -276,6 +616,7 @@ class Occurrence(Item):
 
     def __init__(self, master, recurrence_id):
         self.master = master
+        self._master_recurrence = Recurrence(master)
         self.hashable_recurrence_id = to_hashable(recurrence_id)
         return super(Occurrence, self).__init__()
 
@@ -311,7 +652,7 @@ class Occurrence(Item):
 
     @trellis.compute
     def modification_recipe(self):
-        return Recurrence(self.master).modification_recipes.get(self.hashable_recurrence_id)
+        return self._master_recurrence.modification_recipes.get(self.hashable_recurrence_id)
 
     @trellis.modifier
     def unmodify(self):
@@ -368,4 +709,4 @@ def occurrence_triage(item):
         else:
             return ((timestamp(start), DONE),)
 
-plugins.Hook('chandler.domain.triage').register(occurrence_triage)
+register_hook(plugins.Hook('chandler.domain.triage'), occurrence_triage)
@@ -18,6 +18,18 @@ class ReminderList(ItemAddOn):
     def remove_all_reminders(self):
         self.reminders[:] = []
 
+    @classmethod
+    @trellis.modifier
+    def bulk_add_reminder(cls, items, **kwargs):
+        """Add a reminder to each of items in a single transaction."""
+        return [cls(item).add_reminder(**kwargs) for item in items]
+
+    @classmethod
+    @trellis.modifier
+    def bulk_remove_all_reminders(cls, items):
+        for item in items:
+            cls(item).remove_all_reminders()
+
 class Reminder(trellis.Component):
     trellis.attrs(
         item=None,
@@ -0,0 +1,145 @@
+#   Copyright (c) 2009 Open Source Applications Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Periodically save changes without blocking the trellis thread"""
+
+import logging, threading, Queue
+import peak.events.trellis as trellis
+import peak.events.activity as activity
+from peak import context
+from chandler.time_services import TimerWheel, nowTimestamp
+
+__all__ = ('AutoSave', 'BackgroundWriter', 'start_autosave')
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWriter(object):
+    """Run a Journal's appends and compactions on a background thread."""
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="autosave")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def append(self, changes):
+        self.queue.put((self.journal.append, changes))
+
+    def compact(self, groups):
+        self.queue.put((self.journal.compact_groups, groups))
+
+    def stop(self):
+        """Wait for everything queued so far to be written."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            write, argument = job
+            try:
+                write(argument)
+            except Exception:
+                logger.exception("Autosave failed")
+
+
+class AutoSave(trellis.Component, context.Service):
+    """Save the changes noticed by a ChangeTracker every so often.
+
+    Changes are saved once nothing has changed for ``interval`` seconds,
+    or ``max_latency`` seconds after the first unsaved change, whichever
+    comes first.  The changed records are taken from the tracker on the
+    trellis thread, which is quick, since the tracker already has them;
+    writing them out happens on a BackgroundWriter's thread.  Once
+    ``compact_after`` changes have been journaled, the next save writes a
+    whole new snapshot instead; only the list of each item's records is
+    made on the trellis thread, and sorting them into dump order is left
+    to the writer.
+
+    """
+
+    interval = trellis.attr(30.0)
+    max_latency = trellis.attr(300.0)
+    compact_after = trellis.attr(1000)
+
+    tracker = trellis.attr(None)
+    writer = None
+
+    _first_change = _last_change = None
+    _journaled = 0
+
+    def start(self, tracker, journal):
+        """Save tracker's changes to journal from now on."""
+        tracker.journal = None
+        self.writer = BackgroundWriter(journal)
+        self._journaled = journal.entries
+        self.tracker = tracker
+
+    def stop(self):
+        """Stop saving, after waiting for pending writes to finish.
+
+        Changes that haven't been handed to the writer yet are left in
+        the tracker.
+
+        """
+        self.tracker = None
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+
+    @trellis.perform
+    def _autosave(self):
+        tracker = self.tracker
+        if tracker is None:
+            return
+        if tracker.changed:
+            self._last_change = nowTimestamp()
+            if self._first_change is None:
+                self._first_change = self._last_change
+        if self._first_change is None:
+            return
+        due = min(self._last_change + self.interval,
+                  self._first_change + self.max_latency)
+        if TimerWheel.reached(due):
+            self.save()
+
+    def save(self):
+        """Hand the tracker's changes to the writer now."""
+        self._first_change = self._last_change = None
+        changes = self.tracker.take_changes()
+        if self._journaled + len(changes) >= self.compact_after:
+            self.writer.compact(self.tracker.record_groups())
+            self._journaled = 0
+        elif changes:
+            self.writer.append(changes)
+            self._journaled += len(changes)
+
+
+def start_autosave(app):
+    """Start autosaving once the domain has been loaded and tracked.
+
+    This is a ``chandler.launch.app`` hook; since other hooks for that
+    event load the domain, the real work waits for the event loop.
+
+    """
+    def start():
+        from chandler.main import Persistence
+        if Persistence.tracker is not None:
+            AutoSave.start(Persistence.tracker, Persistence.journal)
+    activity.EventLoop.call(start)
@@ -0,0 +1,183 @@
+#   Copyright (c) 2009 Open Source Applications Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Differences between two dumps of the store, one item at a time"""
+
+from __future__ import with_statement
+
+import logging, sys
+from chandler.sharing import eim, dumpreload
+from chandler.sharing.dumpreload import PickleSerializer
+
+__all__ = ('group_records', 'diff_groups', 'export_delta', 'diff_snapshots',
+           'dump_delta', 'load_delta', 'apply_delta')
+
+logger = logging.getLogger(__name__)
+
+
+def group_records(records):
+    """Yield (alias, records) pairs from a stream of dumped records.
+
+    Each record's alias comes from dumpreload.record_alias(), the same
+    alias dump() sorts on.  Records without one (collection memberships,
+    for example) belong to the alias before them, since that's the item
+    that exported them.
+
+    """
+    alias, group = None, []
+    for record in records:
+        record_alias = dumpreload.record_alias(record)
+        if record_alias and record_alias != alias:
+            if group:
+                yield alias, group
+            alias, group = record_alias, []
+        group.append(record)
+    if group:
+        yield alias, group
+
+def _in_order(groups):
+    previous = None
+    for alias, records in groups:
+        if previous is not None and alias <= previous:
+            raise ValueError("Records aren't sorted by alias at %r" % (alias,))
+        previous = alias
+        yield alias, records
+
+def _advance(groups):
+    try:
+        return groups.next()
+    except StopIteration:
+        return None
+
+def diff_groups(old, new):
+    """Yield (alias, eim.Diff) for each alias that differs from old to new.
+
+    old and new are iterables of (alias, records) pairs, sorted by alias,
+    which are merged a pair at a time, so neither side is ever entirely
+    in memory.
+
+    """
+    old, new = _in_order(old), _in_order(new)
+    old_group, new_group = _advance(old), _advance(new)
+    while old_group is not None or new_group is not None:
+        if new_group is None or (old_group is not None and
+                                 old_group[0] < new_group[0]):
+            yield old_group[0], eim.Diff([], old_group[1])
+            old_group = _advance(old)
+        elif old_group is None or new_group[0] < old_group[0]:
+            yield new_group[0], eim.Diff(new_group[1])
+            new_group = _advance(new)
+        else:
+            diff = eim.RecordSet(new_group[1]) - eim.RecordSet(old_group[1])
+            if diff:
+                yield new_group[0], diff
+            old_group, new_group = _advance(old), _advance(new)
+
+def _snapshot_groups(previous, serializer, gzip):
+    if isinstance(previous, basestring) or hasattr(previous, 'read'):
+        return group_records(dumpreload.load_records(previous, serializer,
+                                                     gzip))
+    return previous
+
+def export_delta(previous, uuids, serializer=PickleSerializer, gzip=False):
+    """Yield (alias, eim.Diff) for the items that changed since previous.
+
+    previous is a .chex file (or stream) written by dump(), or an
+    iterable of (alias, records) pairs sorted by alias.  uuids are the
+    aliases of the items to compare, as they would be passed to dump().
+
+    """
+    aliases = sorted(uuids)
+    current = group_records(dumpreload.iter_records(aliases))
+    return diff_groups(_snapshot_groups(previous, serializer, gzip), current)
+
+def diff_snapshots(old, new, serializer=PickleSerializer, gzip=False):
+    """Yield (alias, eim.Diff) for the differences between two .chex files"""
+    return diff_groups(_snapshot_groups(old, serializer, gzip),
+                       _snapshot_groups(new, serializer, gzip))
+
+def dump_delta(stream, changes, serializer=PickleSerializer):
+    """Write (alias, eim.Diff) pairs to stream, returning how many there were.
+
+    Each is written as an (alias, inclusions, exclusions) tuple, the same
+    format as a Journal's entries.
+
+    """
+    dump = serializer.dumper(stream)
+    count = 0
+    for alias, diff in changes:
+        dump((alias, list(diff.inclusions), list(diff.exclusions)))
+        count += 1
+    return count
+
+def load_delta(stream, serializer=PickleSerializer):
+    """Yield (alias, eim.Diff) pairs from a stream written by dump_delta()"""
+    load = serializer.loader(stream)
+    while True:
+        try:
+            alias, inclusions, exclusions = load()
+        except EOFError:
+            break
+        yield alias, eim.Diff(inclusions, exclusions)
+
+def apply_delta(stream, serializer=PickleSerializer):
+    """Import the changes in a delta, returning how many there were."""
+    trans = dumpreload.getTranslator()()
+    trans.startImport()
+    count = 0
+    for alias, diff in load_delta(stream, serializer):
+        trans.importRecords(diff)
+        count += 1
+    trans.finishImport()
+    return count
+
+
+def main(argv=None):
+    """Make or apply delta files from the command line.
+
+    ``chandler-delta make OLD NEW DELTA`` writes the changes from the
+    dump OLD to the dump NEW.  ``chandler-delta apply BASE DELTA OUTPUT``
+    loads BASE, applies DELTA to it, and dumps the result to OUTPUT.
+    Files whose names end in .gz are compressed.
+
+    """
+    import optparse
+    parser = optparse.OptionParser(
+        usage="%prog make OLD NEW DELTA\n       %prog apply BASE DELTA OUTPUT")
+    options, arguments = parser.parse_args(argv)
+    if len(arguments) != 4 or arguments[0] not in ('make', 'apply'):
+        parser.error("expected make or apply, and three files")
+    command, paths = arguments[0], arguments[1:]
+    zipped = [path.endswith('.gz') for path in paths]
+
+    if command == 'make':
+        old, new, delta = paths
+        changes = diff_groups(
+            group_records(dumpreload.load_records(old, gzip=zipped[0])),
+            group_records(dumpreload.load_records(new, gzip=zipped[1])))
+        with open(delta, 'wb') as output:
+            count = dump_delta(output, changes)
+        logger.info("Wrote %d changes to %s", count, delta)
+    else:
+        from chandler.main import export_plan
+        base, delta, output = paths
+        dumpreload.reload(base, gzip=zipped[0])
+        with open(delta, 'rb') as input:
+            count = apply_delta(input)
+        logger.info("Applied %d changes from %s", count, delta)
+        dumpreload.dump_to_path(output, export_plan(), gzip=zipped[2])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -98,33 +98,83 @@ class PickleSerializer(object):
             eim.uri_registry[uri] = rtype
             return rtype
 
-def dump(stream, uuids, serializer=PickleSerializer, obfuscate=False, gzip=False):
+def dump(stream, uuids, serializer=PickleSerializer, obfuscate=False, gzip=False,
+         ordered=False):
+
+    if not uuids:
+        uuids = ()
+
+    if ordered:
+        # The caller already put masters before occurrences.  The dump
+        # can be reloaded, but not merged by chandler.sharing.delta.
+        aliases = uuids
+    else:
+        # Sort on alias so masters are dumped before occurrences
+        aliases = sorted(uuids)
+
+    dump_records(stream, iter_records(aliases, obfuscate), serializer, gzip)
+
+def iter_records(aliases, obfuscate=False):
+    """Yield the records dump() would write for aliases, in the same order"""
 
     translator_class = getTranslator()
 
     trans = translator_class()
     trans.obfuscation = obfuscate
 
-    if not uuids:
-        uuids = ()
-    aliases = uuids
+    trans.startExport()
+
+    for alias in aliases:
+        item = trans.getItemForAlias(alias)
+        for record in trans.exportItem(item):
+            yield record
+
+    for record in trans.finishExport():
+        yield record
 
-    # Sort on alias so masters are dumped before occurrences
-    aliases.sort()
+def record_alias(record):
+    """Return the alias of the item that exported record, if it says.
 
-    trans.startExport()
+    Most records carry the item's uuid, but a keyword's records carry its
+    keywordID, which is the keyword's alias.  Records that don't say, like
+    collection memberships, return None; in a dump, they belong to the
+    alias before them.
+
+    """
+    return getattr(record, 'uuid', None) or getattr(record, 'keywordID', None)
+
+def load_records(filename_or_stream, serializer=PickleSerializer, gzip=False):
+    """Yield the records in a file written by dump(), without importing them"""
+
+    if isinstance(filename_or_stream, basestring):
+        input = open(filename_or_stream, "rb")
+    else:
+        input = filename_or_stream
+
+    original_input = input
+    if gzip:
+        input = GzipFile(fileobj=input)
+
+    try:
+        load = serializer.loader(input)
+        while True:
+            record = load()
+            if not record:
+                break
+            yield record
+    finally:
+        input.close()
+        original_input.close()
+
+def dump_records(stream, records, serializer=PickleSerializer, gzip=False):
+    """Write already-exported records to stream, in the format dump() uses"""
 
     if gzip:
         stream = GzipFile(fileobj=stream)
 
     dump = serializer.dumper(stream)
 
-    for alias in aliases:
-        item = trans.getItemForAlias(alias)
-        for record in trans.exportItem(item):
-            dump(record)
-
-    for record in trans.finishExport():
+    for record in records:
         dump(record)
 
     dump(None)
@@ -152,10 +202,24 @@ def overwrite_rename(from_path, to_path):
     os.rename(from_path, to_path)
 
 
-def dump_to_path(path, uuids=None, serializer=PickleSerializer, obfuscate=False, gzip=False):
+def dump_to_path(path, uuids=None, serializer=PickleSerializer, obfuscate=False, gzip=False,
+                 ordered=False):
     """
     Dumps EIM records to a file, file permissions 0600.
     """
+    _write_to_path(path,
+                   lambda output: dump(output, uuids, serializer, obfuscate, gzip,
+                                       ordered))
+
+def dump_records_to_path(path, records, serializer=PickleSerializer, gzip=False):
+    """
+    Like dump_to_path(), but writes records that have already been
+    exported, so it's safe to call from a thread other than the trellis'.
+    """
+    _write_to_path(path,
+                   lambda output: dump_records(output, records, serializer, gzip))
+
+def _write_to_path(path, write):
 
     # Paths here:
     #
@@ -179,7 +243,7 @@ def dump_to_path(path, uuids=None, serializer=PickleSerializer, obfuscate=False,
 
     try:
         with os.fdopen(fd, 'wb') as output:
-            dump(output, uuids, serializer, obfuscate, gzip)
+            write(output)
 
         # Next, remove the .temp from the filename. This means that
         # we have a complete, recoverable .chex file on disk (yay).
@@ -199,8 +263,13 @@ def dump_to_path(path, uuids=None, serializer=PickleSerializer, obfuscate=False,
 
         raise
 
-def reload(filename_or_stream, serializer=PickleSerializer, gzip=False):
-    """ Loads EIM records from a file and applies them """
+def reload(filename_or_stream, serializer=PickleSerializer, gzip=False,
+           item_class=None):
+    """ Loads EIM records from a file and applies them
+
+    New items are created as item_class, e.g. ColdItem for archives that
+    are rarely looked at, or the translator's own item_class by default.
+    """
 
 
     if isinstance(filename_or_stream, basestring):
@@ -216,6 +285,8 @@ def reload(filename_or_stream, serializer=PickleSerializer, gzip=False):
     translator_class = getTranslator()
 
     trans = translator_class()
+    if item_class is not None:
+        trans.item_class = item_class
     trans.startImport()
 
     try:
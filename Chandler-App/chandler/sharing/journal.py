@@ -0,0 +1,297 @@
+#   Copyright (c) 2009 Open Source Applications Foundation
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Append-only journal of EIM changes on top of a .chex snapshot"""
+
+from __future__ import with_statement
+
+import logging, os
+import peak.events.trellis as trellis
+from chandler.sharing import eim, dumpreload
+from chandler.sharing.dumpreload import PickleSerializer
+
+__all__ = ('ChangeTracker', 'Journal')
+
+logger = logging.getLogger(__name__)
+
+
+def _undo(func, *args):
+    """Undo with func(*args) if the current transaction is rolled back"""
+    if trellis.ctrl.active:
+        trellis.on_undo(func, *args)
+
+
+class ChangeTracker(trellis.Component):
+    """Keep track of the items whose exported records have changed.
+
+    Every collection in ``collections``, and every item in those
+    collections, gets a cell whose rule exports its records.  Since
+    exporting reads the item's cells, the trellis recalculates the records
+    whenever anything that would be exported changes, and the item becomes
+    dirty.  Items that are already in ``collections`` when the tracker is
+    created are assumed to be saved already, and get EIM before tracking
+    starts.  Items that leave every collection stop being tracked.
+
+    If ``journal`` is set, the changes made by each transaction are
+    appended to it as soon as the transaction is over.
+
+    """
+
+    collections = trellis.make(trellis.Set, writable=True)
+    journal = trellis.attr(None)
+
+    translator = trellis.make(lambda self: dumpreload.getTranslator()())
+
+    # The items changed by the most recent transaction
+    _changed = trellis.todo(set)
+    changed = _changed
+    to_change = _changed.future
+
+    # item -> cell of the item's exported records, in export order
+    _cells = trellis.make(dict)
+    # item -> the records most recently returned by take_changes()
+    _taken = trellis.make(dict)
+    # items whose records have changed since they were last taken; every
+    # change to this and the dicts above is undone with its transaction
+    _dirty = trellis.make(dict)
+
+    def __init__(self, **kw):
+        # Add EIM up front, in one modifier, rather than item by item from
+        # inside _follow_collections
+        eim.add_eim([item for collection in kw.get('collections', ())
+                          for item in [collection] + list(collection.items)])
+        super(ChangeTracker, self).__init__(**kw)
+
+    @trellis.compute(resetting_to=None)
+    def _new_collections(self):
+        return self.collections
+
+    @trellis.maintain
+    def _follow_collections(self):
+        new_collections = self._new_collections
+        untracked = []
+        if new_collections is not None:
+            saved = True
+            for collection in new_collections:
+                untracked.append(collection)
+                untracked.extend(collection.items)
+        else:
+            saved = False
+            for collection in self.collections.added:
+                untracked.append(collection)
+                untracked.extend(collection.items)
+        for collection in self.collections:
+            untracked.extend(collection.items.added)
+        untracked = [item for item in untracked if item not in self._cells]
+        # Items added to a collection after tracking started may not have
+        # EIM yet; they get it in one batch, before any is exported
+        missing = [item for item in untracked
+                   if not eim.EIM.installed_on(item)]
+        if missing:
+            eim.add_eim(missing)
+        for item in untracked:
+            self._track(item, saved)
+
+        # Items that have left every tracked collection aren't exported any
+        # more, so their cells and records are let go
+        if new_collections is not None:
+            leaving = list(self._cells)
+        else:
+            leaving = []
+            for collection in self.collections.removed:
+                leaving.append(collection)
+                leaving.extend(collection.items)
+            for collection in self.collections:
+                leaving.extend(collection.items.removed)
+        for item in leaving:
+            if item in self._cells and not self._in_collections(item):
+                self._untrack(item)
+
+    def _in_collections(self, item):
+        if item in self.collections:
+            return True
+        for collection in self.collections:
+            if item in collection.items:
+                return True
+        return False
+
+    def _track(self, item, saved):
+        if item in self._cells:
+            return
+        if not saved:
+            self._taken[item] = ()
+            trellis.on_undo(self._taken.pop, item, None)
+        cell = self._cells[item] = trellis.Cell(self._export_rule(item))
+        trellis.on_undo(self._cells.pop, item, None)
+        records = cell.value
+        if saved:
+            self._taken[item] = records
+            trellis.on_undo(self._taken.pop, item, None)
+
+    def _untrack(self, item):
+        # Once the cell is dropped, nothing refers to it, and the trellis
+        # stops recalculating it
+        trellis.on_undo(self._cells.__setitem__, item, self._cells.pop(item))
+        for records in self._taken, self._dirty:
+            if item in records:
+                trellis.on_undo(records.__setitem__, item, records.pop(item))
+
+    def _export_rule(self, item):
+        def export():
+            records = tuple(self.translator.exportItem(item))
+            taken = self._taken.get(item)
+            if taken is not None and set(records) != set(taken):
+                self.to_change.add(item)
+                if item not in self._dirty:
+                    self._dirty[item] = True
+                    trellis.on_undo(self._dirty.pop, item, None)
+            return records
+        return export
+
+    def has_changes(self):
+        return bool(self._dirty)
+
+    def take_changes(self):
+        """Return (alias, Diff) pairs for items changed since the last call.
+
+        The pairs are sorted by alias, so masters come before their
+        modifications.
+
+        """
+        changes = []
+        for item in self._dirty:
+            records = self._cells[item].value
+            diff = eim.RecordSet(records) - eim.RecordSet(self._taken[item])
+            _undo(self._taken.__setitem__, item, self._taken[item])
+            self._taken[item] = records
+            if diff:
+                changes.append((self.translator.getAliasForItem(item), diff))
+        _undo(self._dirty.update, self._dirty.copy())
+        self._dirty.clear()
+        changes.sort(key=lambda change: change[0])
+        return changes
+
+    def record_groups(self):
+        """Return a list of every tracked item's records, in no order.
+
+        Only items that are still in a tracked collection are included, the
+        same items export_plan() would yield.  Everything is then considered
+        saved, as if take_changes() had been called.  The records are the
+        tracker's own tuples, so this is quick; Journal.compact_groups()
+        puts them in dump order.
+
+        """
+        self.take_changes()
+        return self._taken.values()
+
+    @trellis.perform
+    def _write_journal(self):
+        if self._changed and self.journal is not None:
+            self.journal.append(self.take_changes())
+
+
+class Journal(object):
+    """A .chex snapshot, plus an append-only file of changes to it.
+
+    Each journal entry is an ``(alias, inclusions, exclusions)`` tuple,
+    the contents of an eim.Diff for one item.  Appending is proportional
+    to the number of changes; compact() writes a fresh snapshot and
+    empties the journal.
+
+    """
+
+    def __init__(self, snapshot_path, path=None, serializer=PickleSerializer,
+                 gzip=False):
+        self.snapshot_path = snapshot_path
+        self.path = path or snapshot_path + '.journal'
+        self.serializer = serializer
+        self.gzip = gzip
+        self.entries = 0
+
+    def exists(self):
+        return os.path.isfile(self.snapshot_path) or os.path.isfile(self.path)
+
+    def append(self, changes):
+        """Append (alias, Diff) pairs, and make sure they're on disk."""
+        if not changes:
+            return
+        with open(self.path, 'ab') as output:
+            os.chmod(self.path, 0600)
+            dump = self.serializer.dumper(output)
+            for alias, diff in changes:
+                dump((alias, list(diff.inclusions), list(diff.exclusions)))
+            output.flush()
+            os.fsync(output.fileno())
+        self.entries += len(changes)
+
+    def compact(self, uuids, ordered=False):
+        """Replace the snapshot with a dump of uuids, and empty the journal."""
+        dumpreload.dump_to_path(self.snapshot_path, uuids, self.serializer,
+                                gzip=self.gzip, ordered=ordered)
+        self._truncate()
+
+    def compact_groups(self, groups):
+        """Like compact(), but with records that have already been exported.
+
+        groups holds a sequence of records for each item, like
+        ChangeTracker.record_groups() returns, in any order.  They're sorted
+        on the alias of each group's first record, as dump() sorts, and
+        written out one after another.  Nothing here touches the trellis,
+        so this can run on another thread.
+
+        """
+        groups = sorted((records for records in groups if records),
+                        key=lambda records: dumpreload.record_alias(records[0]))
+        dumpreload.dump_records_to_path(
+            self.snapshot_path,
+            (record for records in groups for record in records),
+            self.serializer, gzip=self.gzip)
+        self._truncate()
+
+    def _truncate(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.entries = 0
+
+    def replay(self):
+        """Reload the snapshot, then import the journal's changes."""
+        if os.path.isfile(self.snapshot_path):
+            dumpreload.reload(self.snapshot_path, self.serializer,
+                              gzip=self.gzip)
+        if not os.path.isfile(self.path):
+            return
+
+        trans = dumpreload.getTranslator()()
+        trans.startImport()
+        with open(self.path, 'r+b') as input:
+            load = self.serializer.loader(input)
+            good = 0
+            while True:
+                try:
+                    alias, inclusions, exclusions = load()
+                except EOFError:
+                    break
+                except Exception:
+                    # A save was interrupted; drop the partial entry so
+                    # later entries aren't appended after it
+                    logger.warning("Truncating %s after %d entries",
+                                   self.path, self.entries)
+                    input.truncate(good)
+                    break
+                trans.importRecords(eim.Diff(inclusions, exclusions))
+                self.entries += 1
+                good = input.tell()
+        trans.finishImport()
+        logger.info("Replayed %d journal entries", self.entries)
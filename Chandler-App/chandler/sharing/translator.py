@@ -314,12 +314,15 @@ class SharingTranslator(eim.Translator):
             return super(SharingTranslator, self).getItemForAlias(alias)
 
         # a modification
-        master = eim.item_for_uuid(uuid)
+        master = eim.item_for_uuid(uuid, self.item_class)
         return Recurrence(master).get_occurrence(recurrence_id)
 
     def getAliasForItem(self, item):
         return getAliasForItem(item)
 
+    def cache_key(self):
+        return type(self), self.obfuscation
+
 
     def withItemForUUID(self, alias, itype=Item, **attrs):
         """Handle recurrence modification aliases."""
@@ -670,6 +673,8 @@ class DumpTranslator(SharingTranslator):
     version = 1
     description = u"Translator for Chandler items (PIM and non-PIM)"
 
+    record_cache = True
+
     def exportItem(self, item):
         if isinstance(item, Occurrence):
             if not item.modification_recipe:
@@ -701,10 +706,8 @@ class DumpTranslator(SharingTranslator):
         keyword = keyword_for_id(record.keywordID)
         if not eim.EIM.installed_on(keyword):
             eim.EIM(keyword).add()
-        for sidebar_entry in ChandlerApplication.sidebar_entries:
-            if sidebar_entry.collection is keyword:
-                break
-        else:
+        sidebar_entry = ChandlerApplication.sidebar_entry_for(keyword)
+        if sidebar_entry is None:
             sidebar_entry = SidebarEntry(collection=keyword)
             ChandlerApplication.sidebar_entries.add(sidebar_entry)
 
@@ -715,9 +718,9 @@ class DumpTranslator(SharingTranslator):
     @eim.exporter(_Keyword)
     def export_keyword(self, keyword):
         red = green = blue = alpha = None
-        for sidebar_entry in ChandlerApplication.sidebar_entries:
-            if sidebar_entry.collection is keyword:
-                red, green, blue = self.hsv_to_rgb(sidebar_entry.hsv_color)
+        sidebar_entry = ChandlerApplication.sidebar_entry_for(keyword)
+        if sidebar_entry is not None:
+            red, green, blue = self.hsv_to_rgb(sidebar_entry.hsv_color)
 
         yield new_model.KeywordRecord(
             keyword.well_known_name,
@@ -735,10 +738,8 @@ class DumpTranslator(SharingTranslator):
         if not isinstance(collection, Collection):
             raise TypeError("An Item was created instead of a Collection")
 
-        for sidebar_entry in ChandlerApplication.sidebar_entries:
-            if sidebar_entry.collection is collection:
-                break
-        else:
+        sidebar_entry = ChandlerApplication.sidebar_entry_for(collection)
+        if sidebar_entry is None:
             sidebar_entry = SidebarEntry(collection=collection)
             ChandlerApplication.sidebar_entries.add(sidebar_entry)
 
@@ -749,9 +750,9 @@ class DumpTranslator(SharingTranslator):
     @eim.exporter(Collection)
     def export_collection(self, collection):
         red = green = blue = alpha = None
-        for sidebar_entry in ChandlerApplication.sidebar_entries:
-            if sidebar_entry.collection is collection:
-                red, green, blue = self.hsv_to_rgb(sidebar_entry.hsv_color)
+        sidebar_entry = ChandlerApplication.sidebar_entry_for(collection)
+        if sidebar_entry is not None:
+            red, green, blue = self.hsv_to_rgb(sidebar_entry.hsv_color)
 
         yield model.ItemRecord(
             collection,                                  # uuid
@@ -798,7 +799,7 @@ class DumpTranslator(SharingTranslator):
             return
 
         collection = eim.collection_for_name(record.collectionID)
-        collection.add(eim.item_for_uuid(record.itemUUID))
+        collection.add(eim.item_for_uuid(record.itemUUID, self.item_class))
 
     @model.DashboardMembershipRecord.importer
     def import_dashboard_membership(self, record):
@@ -90,30 +90,31 @@ class Sidebar(core.Table):
 
     @trellis.maintain
     def filtered_items(self):
-        return core.FilteredSubset(
+        return core.IndexedSubset(
             input=self.all_items,
-            predicate=trellis.Cell(lambda:self.filters.value))
+            extension=trellis.Cell(lambda:self.filters.value))
 
     @trellis.maintain
     def filters(self):
-        # need to add a hook for the choices
+        # need to add a hook for the choices.  Each value is the Extension
+        # to filter on, or None for all items.
         return core.Choice(
             scope=self,
             choices=trellis.List([
                 core.ChoiceItem(
                     label=u'All',
                     help=u'View all items',
-                    value=lambda item: True,
+                    value=None,
                     hints={'icon': 'ApplicationBarAll.png'}),
                 core.ChoiceItem(
                     label=u'Calendar',
                     help=u'View events',
-                    value=event.Event.installed_on,
+                    value=event.Event,
                     hints={'icon': 'ApplicationBarEvent.png'}),
                 core.ChoiceItem(
                     label=u'Starred',
                     help=u'View Starred Items',
-                    value=starred.Starred.installed_on,
+                    value=starred.Starred,
                     hints={'icon': 'ApplicationBarStarred.png'}),
             ]),
             hints={'toolbar': True},
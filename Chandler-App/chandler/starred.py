@@ -1,4 +1,14 @@
+import peak.events.trellis as trellis
 import chandler.core as core
 
 class Starred(core.Extension):
-    pass
+
+    @classmethod
+    @trellis.modifier
+    def bulk_toggle(cls, items):
+        """Star unstarred items and unstar starred ones, in one transaction."""
+        for item in items:
+            if cls.installed_on(item):
+                cls(item).remove()
+            else:
+                cls(item).add()
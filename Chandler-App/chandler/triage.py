@@ -1,8 +1,9 @@
 import peak.events.trellis as trellis
+import peak.context as context
 from peak.util import plugins
 import peak.events.activity as activity
 from chandler.time_services import nowTimestamp, is_past_timestamp
-from chandler.core import ConstraintError, ItemAddOn
+from chandler.core import ConstraintError, ItemAddOn, hook_registry_state
 
 ### Constants ###
 
@@ -14,21 +15,59 @@ TRIAGE_HOOK  = plugins.Hook('chandler.domain.triage')
 
 ### Domain model ###
 
+class TriageHooks(context.Service):
+    """
+    The callables registered with TRIAGE_HOOK, looked up once rather than
+    every time an item's triage is recalculated.  The lookup is repeated
+    whenever hook registrations change, so register triage hooks with
+    chandler.core.register_hook().
+    """
+
+    callables = ()
+    _registry_state = None
+
+    def refresh(self):
+        self._registry_state = hook_registry_state()
+        self.callables = tuple(TRIAGE_HOOK)
+
+    def query(self, item):
+        if self._registry_state != hook_registry_state():
+            self.refresh()
+        for hook in self.callables:
+            yield hook(item)
+
 def triage_status_timeline(triage):
     """Yield all (timestamp, status) pairs for the given item."""
     yield (0, NOW) # default
     manual_pair = triage.manual_timestamp, triage.manual
     if None not in manual_pair:
         yield manual_pair
-    for iterable in TRIAGE_HOOK.query(triage._item):
+    for iterable in TriageHooks.query(triage._item):
         for pair in iterable:
             yield pair
 
+def partition_on_time(triage):
+    """Return lists of past and future (timestamp, status) pairs.
+
+    Rather than waiting on every future timestamp, only the next
+    transition is scheduled with TimerWheel.  A rule calling this is
+    recalculated when that transition passes, and then schedules the
+    one after it.
+    """
+    now = nowTimestamp()
+    past, future = [], []
+    for pair in triage_status_timeline(triage):
+        if pair[0] <= now:
+            past.append(pair)
+        else:
+            future.append(pair)
+    if future:
+        is_past_timestamp(min(future)[0])
+    return past, future
+
 def filter_on_time(triage, future=True):
     """Yield all past or future (timestamp, status) pairs for the given item."""
-    for timestamp, status in triage_status_timeline(triage):
-        if future ^ is_past_timestamp(timestamp): # ^ means XOR
-            yield timestamp, status
+    return iter(partition_on_time(triage)[future])
 
 
 class Triage(ItemAddOn):
@@ -40,7 +79,7 @@ class Triage(ItemAddOn):
 
     @trellis.compute
     def auto(self):
-        max_timestamp, status = max(filter_on_time(self, future=False))
+        max_timestamp, status = max(partition_on_time(self)[0])
         return status
 
 
@@ -58,6 +97,19 @@ class Triage(ItemAddOn):
             if cell is not None and int(cell) < 100:
                 raise TriageRangeError(cell)
 
+    @classmethod
+    @trellis.modifier
+    def bulk_set_manual(cls, items, manual, manual_timestamp=None):
+        """Set manual triage for many items in a single transaction.
+
+        manual_timestamp is left alone unless one is given.
+        """
+        for item in items:
+            triage = cls(item)
+            triage.manual = manual
+            if manual_timestamp is not None:
+                triage.manual_timestamp = manual_timestamp
+
 class TriagePosition(ItemAddOn):
     trellis.attrs(
         pinned_triage_section=None,
@@ -70,13 +122,11 @@ class TriagePosition(ItemAddOn):
 
     @trellis.compute
     def default_position(self):
-        triage = Triage(self._item)
-        if self._triage_addon.calculated == LATER:
-            future_choices = list(filter_on_time(triage, future=True))
-            if future_choices:
-                return min(future_choices)[0]
+        past, future = partition_on_time(Triage(self._item))
+        if self._triage_addon.calculated == LATER and future:
+            return min(future)[0]
         # if LATER but no known triage change in the future, use NOW behavior
-        last_past = max(filter_on_time(triage, future=False))
+        last_past = max(past)
         # never return a timestamp less than the item's creation timestamp
         return max(self._item.created, last_past[0])
 
@@ -115,5 +165,17 @@ class TriagePosition(ItemAddOn):
         self.pinned_triage_section = NOW
         self.pinned_position = nowTimestamp()
 
+    @classmethod
+    @trellis.modifier
+    def bulk_pin(cls, items):
+        for item in items:
+            cls(item).pin()
+
+    @classmethod
+    @trellis.modifier
+    def bulk_clear_pinned(cls, items):
+        for item in items:
+            cls(item).clear_pinned()
+
 class TriageRangeError(ConstraintError):
     cell_description = "triage status"
@@ -30,6 +30,7 @@ setup(
     keyword = chandler.keyword:ItemKeywords
     [chandler.launch.app]
     interaction = chandler.main:load_interaction
+    autosave = chandler.sharing.autosave:start_autosave
     [chandler.launch.wxui]
     wxui = chandler.wxui.presentation:load_wxui
     [chandler.wxui.table.extensions]
@@ -37,5 +38,6 @@ setup(
     DashboardIcons = chandler.dashboard:extend_table
     [console_scripts]
     chandler-demo = chandler.main:main
+    chandler-delta = chandler.sharing.delta:main
     """
 ),
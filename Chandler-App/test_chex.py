@@ -1,15 +1,17 @@
 import unittest
 import datetime
 import os
-from chandler.core import Item, Collection
+from chandler.core import Item, ColdItem, Collection
 from chandler.event import Event
-from chandler.time_services import TimeZone
+from chandler.time_services import TimeZone, setNow
 from chandler.main import ChandlerApplication
 from chandler.sharing.dumpreload import reload, dump
 from chandler.sharing.eim import _items_by_uuid, get_item_for_uuid
 from chandler.sharing.translator import str_uuid_for
 from chandler.sidebar import SidebarEntry
 import pkg_resources
+import peak.events.trellis as trellis
+import peak.events.activity as activity
 
 class ChexTestCase(unittest.TestCase):
     """Extra tests beyond what's useful in the doctests."""
@@ -28,6 +30,8 @@ class ChexTestCase(unittest.TestCase):
     def _find_sidebar_entry(self, collection):
         for entry in ChandlerApplication.sidebar_entries:
             if entry.collection is collection:
+                self.assert_(ChandlerApplication.sidebar_entry_for(collection)
+                             is entry)
                 return entry
         self.fail("The collection didn't have a sidebar entry created.")
 
@@ -54,11 +58,19 @@ class ChexTestCase(unittest.TestCase):
         entry = self._find_sidebar_entry(get_item_for_uuid(self.work_collection_uuid))
         self.assertEqual(entry.hsv_color[0], 210.0)
 
+    def test_cold_chex_import(self):
+        """Items are only reloaded as ColdItems when asked for."""
+        reload(self._load('chex_chandler2.gz'), gzip=True, item_class=ColdItem)
+        self.assertEqual(len(_items_by_uuid), 49)
+        self.assert_(isinstance(get_item_for_uuid(self.event_uuid), ColdItem))
+        self._after_import_tests()
+
     def test_new_chex_import(self):
         """Success when importing new style chex files."""
         self.assertEqual(len(_items_by_uuid), 0)
         reload(self._load('chex_chandler2.gz'), gzip=True)
         self.assertEqual(len(_items_by_uuid), 49)
+        self.failIf(isinstance(get_item_for_uuid(self.event_uuid), ColdItem))
         self._after_import_tests()
 
     def test_chex_export(self):
@@ -79,6 +91,296 @@ class ChexTestCase(unittest.TestCase):
             except:
                 pass
 
+    def test_export_plan(self):
+        """Items in several collections are only exported once."""
+        from chandler.main import export_plan
+        from chandler.sharing.eim import EIM
+        work, home = Collection(title="Work"), Collection(title="Home")
+        for collection in work, home:
+            ChandlerApplication.sidebar_entries.add(
+                SidebarEntry(collection=collection))
+        item = Item(title="Both")
+        work.add(item)
+        home.add(item)
+        aliases = list(export_plan())
+        self.assert_(EIM.installed_on(item))
+        self.assertEqual(aliases.count(EIM(item).uuid), 1)
+        self.assertEqual(len(aliases), len(set(aliases)))
+
+    def test_sidebar_entry_for(self):
+        """sidebar_entry_for follows reassigned collections and removals."""
+        entry = SidebarEntry(collection=Collection(title="Before"))
+        ChandlerApplication.sidebar_entries.add(entry)
+        old = entry.collection
+        self.assert_(ChandlerApplication.sidebar_entry_for(old) is entry)
+        entry.collection = Collection(title="After")
+        self.assertEqual(ChandlerApplication.sidebar_entry_for(old), None)
+        self.assert_(ChandlerApplication.sidebar_entry_for(entry.collection) is entry)
+        ChandlerApplication.sidebar_entries.remove(entry)
+        self.assertEqual(ChandlerApplication.sidebar_entry_for(entry.collection), None)
+
+    def test_record_cache(self):
+        """Exported records are reused until they're read after a change."""
+        from chandler.sharing.dumpreload import getTranslator
+        from chandler.sharing.eim import RecordCache
+        item = Item(title="Cached")
+        trans = getTranslator()()
+        first = list(trans.exportItem(item))
+        cache = RecordCache(item, trans.cache_key())
+        version = cache.version
+        self.assertEqual(list(getTranslator()().exportItem(item)), first)
+        self.assertEqual(cache.version, version)
+        item.title = "Changed"
+        self.assertEqual(cache.version, version)
+        self.assertNotEqual(list(trans.exportItem(item)), first)
+        self.assertEqual(cache.version, version + 1)
+
+    def test_delta(self):
+        """A delta holds just the items that changed since a snapshot."""
+        from chandler.sharing.delta import export_delta, dump_delta, apply_delta
+        collection = Collection(title="Delta")
+        ChandlerApplication.sidebar_entries.add(SidebarEntry(collection=collection))
+        item = Item(title="Before")
+        collection.add(item)
+        uuids = [str_uuid_for(x) for x in (collection, item)]
+        delta_path = self.tmp_path + '.delta'
+        try:
+            handle = file(self.tmp_path, 'wb')
+            dump(handle, list(uuids))
+            handle.close()
+            self.assertEqual(list(export_delta(self.tmp_path, uuids)), [])
+
+            item.title = "After"
+            changes = list(export_delta(self.tmp_path, uuids))
+            self.assertEqual([alias for alias, diff in changes],
+                             [str_uuid_for(item)])
+            handle = file(delta_path, 'wb')
+            self.assertEqual(dump_delta(handle, changes), 1)
+            handle.close()
+
+            item.title = "Before"
+            handle = file(delta_path, 'rb')
+            self.assertEqual(apply_delta(handle), 1)
+            self.assertEqual(item.title, "After")
+        finally:
+            handle.close()
+            for path in (self.tmp_path, delta_path):
+                try:
+                    os.remove(path)
+                except:
+                    pass
+
+    def test_keyword_delta(self):
+        """Keyword records are grouped under their keyword's alias."""
+        from chandler.main import export_plan
+        from chandler.keyword import Keyword
+        from chandler.sharing.dumpreload import load_records
+        from chandler.sharing.delta import group_records, export_delta
+        for word in u"Errands", u"Reading":
+            keyword = Keyword(word)
+            ChandlerApplication.sidebar_entries.add(
+                SidebarEntry(collection=keyword))
+            keyword.add(Item(title=word))
+        try:
+            handle = file(self.tmp_path, 'wb')
+            dump(handle, export_plan())
+            handle.close()
+            aliases = [alias for alias, records in
+                       group_records(load_records(self.tmp_path))]
+            self.assert_(u'@keyword:Errands' in aliases)
+            self.assert_(u'@keyword:Reading' in aliases)
+            self.assertEqual(aliases, sorted(set(aliases)))
+            self.failIf(set(aliases) - set(export_plan()))
+            self.assertEqual(list(export_delta(self.tmp_path, export_plan())),
+                             [])
+
+            new_item = Item(title="New")
+            Keyword(u"Errands").add(new_item)
+            self.assertEqual(
+                [alias for alias, diff in
+                 export_delta(self.tmp_path, export_plan())],
+                [str_uuid_for(new_item)])
+        finally:
+            try:
+                os.remove(self.tmp_path)
+            except:
+                pass
+
+    def test_compacted_delta(self):
+        """A compacted snapshot is sorted by alias, so it can be diffed."""
+        from chandler.main import export_plan
+        from chandler.sharing.delta import export_delta
+        from chandler.sharing.journal import Journal
+        for title in "Zebra", "Aardvark":
+            collection = Collection(title=title)
+            ChandlerApplication.sidebar_entries.add(
+                SidebarEntry(collection=collection))
+            item = Item(title=title)
+            collection.add(item)
+        journal = Journal(self.tmp_path)
+        try:
+            journal.compact(export_plan())
+            self.assertEqual(list(export_delta(self.tmp_path, export_plan())),
+                             [])
+            item.title = "Changed"
+            self.assertEqual(
+                [alias for alias, diff in
+                 export_delta(self.tmp_path, export_plan())],
+                [str_uuid_for(item)])
+        finally:
+            try:
+                os.remove(self.tmp_path)
+            except:
+                pass
+
+    def test_tracker_removal(self):
+        """Items removed from every tracked collection stop being tracked."""
+        from chandler.sharing.journal import ChangeTracker
+        from chandler.sharing.dumpreload import record_alias
+        work, home = Collection(title="Work"), Collection(title="Home")
+        item = Item(title="Shared")
+        work.add(item)
+        home.add(item)
+        tracker = ChangeTracker(collections=trellis.Set([work, home]))
+        def aliases():
+            return set(record_alias(record)
+                       for records in tracker.record_groups()
+                       for record in records)
+        self.assert_(str_uuid_for(item) in aliases())
+        work.remove(item)
+        self.assert_(str_uuid_for(item) in aliases())
+        home.remove(item)
+        self.failIf(str_uuid_for(item) in aliases())
+        item.title = "Changed"
+        self.failIf(tracker.has_changes())
+        tracker.collections.remove(home)
+        self.failIf(str_uuid_for(home) in aliases())
+
+    def test_compact_groups(self):
+        """Compacted records are the ones dump() would write, in its order."""
+        from chandler.keyword import Keyword
+        from chandler.sharing.journal import ChangeTracker, Journal
+        from chandler.sharing.dumpreload import load_records
+        from chandler.sharing.delta import group_records
+        collection = Collection(title="Compacted")
+        keyword = Keyword(u"Compacted")
+        items = [Item(title=str(n)) for n in range(5)]
+        for item in items:
+            collection.add(item)
+        keyword.add(items[0])
+        tracker = ChangeTracker(collections=trellis.Set([collection, keyword]))
+        gone = items.pop()
+        collection.remove(gone)
+        dump_path = self.tmp_path + '.dump'
+        try:
+            Journal(self.tmp_path).compact_groups(tracker.record_groups())
+            handle = file(dump_path, 'wb')
+            dump(handle, [str_uuid_for(x) for x in [collection] + items] +
+                         [keyword.well_known_name])
+            handle.close()
+            def aliases(path):
+                return [alias for alias, records in
+                        group_records(load_records(path))]
+            self.assertEqual(aliases(self.tmp_path), aliases(dump_path))
+            self.failIf(str_uuid_for(gone) in aliases(self.tmp_path))
+        finally:
+            for path in self.tmp_path, dump_path:
+                try:
+                    os.remove(path)
+                except:
+                    pass
+
+    def test_journal_replay(self):
+        """Changes appended to the journal are imported by replay()."""
+        from chandler.sharing.journal import ChangeTracker, Journal
+        from chandler.sharing.eim import EIM
+        collection = Collection(title="Journaled")
+        item = Item(title="Before")
+        collection.add(item)
+        journal = Journal(self.tmp_path)
+        try:
+            tracker = ChangeTracker(collections=trellis.Set([collection]),
+                                    journal=journal)
+            self.assert_(EIM.installed_on(item))
+            self.failIf(tracker.has_changes())
+            item.title = "After"
+            self.assertEqual(journal.entries, 1)
+            collection.add(Item(title="New"))
+            self.assert_(journal.entries > 1)
+
+            tracker.journal = None
+            item.title = "Before"
+            self.assert_(tracker.has_changes())
+            journal.entries = 0
+            journal.replay()
+            self.assertEqual(item.title, "After")
+            self.assertEqual(len(collection.items), 2)
+        finally:
+            try:
+                os.remove(journal.path)
+            except:
+                pass
+
+    def _autosave(self, **settings):
+        """Autosave a change to an item; return the journal and its uuid."""
+        from chandler.sharing.journal import ChangeTracker, Journal
+        from chandler.sharing.autosave import AutoSave
+        context = activity.Time.new()
+        context.__enter__()
+        setNow(datetime.datetime(2009, 1, 9, 9, tzinfo=TimeZone.pacific))
+        collection = Collection(title="Autosaved")
+        item = Item(title="Before")
+        collection.add(item)
+        journal = Journal(self.tmp_path)
+        autosave = AutoSave(interval=5.0, max_latency=60.0, **settings)
+        try:
+            autosave.start(ChangeTracker(collections=trellis.Set([collection])),
+                           journal)
+            item.title = "After"
+            activity.Time.advance(2.0)
+            self.assert_(autosave.tracker.has_changes())
+            activity.Time.advance(10.0)
+            self.failIf(autosave.tracker.has_changes())
+        finally:
+            autosave.stop()
+            context.__exit__(None, None, None)
+        return journal, str_uuid_for(item)
+
+    def _replay(self, journal, uuid):
+        """Replay journal into an empty store, returning uuid's item."""
+        _items_by_uuid.clear()
+        journal.replay()
+        return get_item_for_uuid(uuid)
+
+    def _remove_journal(self):
+        for path in self.tmp_path, self.tmp_path + '.journal':
+            try:
+                os.remove(path)
+            except:
+                pass
+
+    def test_autosave(self):
+        """AutoSave journals changes once they've been idle long enough."""
+        try:
+            journal, uuid = self._autosave()
+            self.assertEqual(journal.entries, 1)
+            self.failIf(os.path.isfile(journal.snapshot_path))
+            self.assertEqual(self._replay(journal, uuid).title, "After")
+        finally:
+            self._remove_journal()
+
+    def test_autosave_compact(self):
+        """Once enough changes are journaled, AutoSave writes a snapshot."""
+        try:
+            journal, uuid = self._autosave(compact_after=1)
+            self.assertEqual(journal.entries, 0)
+            self.failIf(os.path.isfile(journal.path))
+            item = self._replay(journal, uuid)
+            self.assertEqual(item.title, "After")
+            self.assertEqual([c.title for c in item.collections], ["Autosaved"])
+        finally:
+            self._remove_journal()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,11 @@
 import unittest
+import gc
 from datetime import datetime, timedelta
 from chandler.core import Item
 from chandler.recurrence import *
 from chandler.event import Event
 from chandler.triage import *
+from chandler.reminder import ReminderList
 from chandler.time_services import TimeZone, setNow
 from peak.events import activity
 
@@ -42,6 +44,127 @@ class RecurrenceTestCase(unittest.TestCase):
         first.modify(Event, 'base_start', self.dtstart + timedelta(days=-1))
         self.assertEqual(Triage(first).calculated, DONE)
 
+    def test_done_occurrences_not_created(self):
+        """Occurrences before triaged_done_before aren't created needlessly."""
+        self.event.base_start = self.dtstart - timedelta(days=1000)
+        self.recurrence.triaged_done_before = self.dtstart
+        self.recurrence.frequency = 'daily'
+        # most recent DONE, the NOW occurrence, and the next LATER
+        self.assertEqual(3, len(self.recurrence._recurrence_dashboard_entries))
+        self.assertEqual(3, len(self.recurrence._occurrence_cache))
+        self.assertEqual(Triage(self.recurrence.get_occurrence(self.dtstart)).calculated,
+                         DONE)
+
+    def test_dashboard_window(self):
+        """The walk starts at the last untriaged DONE recurrence-id."""
+        self.event.base_start = self.dtstart - timedelta(days=1000)
+        self.recurrence.triaged_done_before = self.dtstart
+        self.recurrence.frequency = 'daily'
+        window = self.recurrence._dashboard_window(self.dtstart + timedelta(days=1))
+        self.assertEqual(window.next(), self.dtstart)
+        self.recurrence.triage_occurrence(self.dtstart, 0, LATER)
+        yesterday = self.dtstart - timedelta(days=1)
+        self.assert_(to_hashable(yesterday) in self.recurrence.dashboard_recurrence_ids)
+        window = self.recurrence._dashboard_window(self.dtstart + timedelta(days=1))
+        self.assertEqual(window.next(), yesterday)
+        # exdates mean rruleset is walked, with the same result
+        ids = self.recurrence.dashboard_recurrence_ids
+        self.recurrence.exdates.add(self.dtstart - timedelta(days=500))
+        self.assertEqual(self.recurrence.dashboard_recurrence_ids, ids)
+
+    def test_future_done_before(self):
+        """Future recurrence-ids aren't DONE just because of triaged_done_before."""
+        self.recurrence.triaged_done_before = self.dtstart + timedelta(days=10)
+        self.recurrence.frequency = 'daily'
+        # the next occurrence is LATER, so it's on the dashboard
+        tomorrow = to_hashable(self.dtstart + timedelta(days=2))
+        self.assert_(tomorrow in self.recurrence.dashboard_recurrence_ids)
+        self.assertEqual(Triage(self.recurrence.get_occurrence(tomorrow)).calculated,
+                         LATER)
+
+    def test_occurrence_cache_eviction(self):
+        """Unused, unmodified Occurrences are evicted from the cache."""
+        self.recurrence.frequency = 'daily'
+        cache = self.recurrence._occurrence_cache
+        cache.size = 10
+        modified = self.recurrence.get_occurrence(self.dtstart + timedelta(days=3))
+        modified.modify(None, 'title', 'Modified')
+        held = self.recurrence.get_occurrence(self.dtstart + timedelta(days=4))
+        start = self.dtstart + timedelta(days=5)
+        for occurrence in self.recurrence.occurrences_between(start, start + timedelta(days=50)):
+            pass
+        self.assert_(cache.evictions > 0)
+        self.assert_(len(cache) <= cache.size + 1)
+        # modified Occurrences are pinned, others keep their identity while
+        # they're referenced
+        self.assert_(modified in cache._pinned.values())
+        self.assert_(self.recurrence.get_occurrence(held.recurrence_id) is held)
+        self.assertEqual(sorted(cache.stats()),
+                         ['evictions', 'hits', 'misses', 'size'])
+
+    def test_occurrence_state_pinned(self):
+        """Occurrences with triage or reminders of their own aren't evicted."""
+        self.recurrence.frequency = 'daily'
+        cache = self.recurrence._occurrence_cache
+        cache.size = 10
+        triaged = self.dtstart + timedelta(days=3)
+        Triage(self.recurrence.get_occurrence(triaged)).manual = DONE
+        reminded = self.dtstart + timedelta(days=4)
+        ReminderList(self.recurrence.get_occurrence(reminded)).add_reminder(
+            delta=timedelta(minutes=-15))
+        gc.collect()
+        start = self.dtstart + timedelta(days=5)
+        for occurrence in self.recurrence.occurrences_between(start, start + timedelta(days=50)):
+            pass
+        del occurrence
+        gc.collect()
+        self.assertEqual(Triage(self.recurrence.get_occurrence(triaged)).manual, DONE)
+        self.assertEqual(len(ReminderList(self.recurrence.get_occurrence(reminded)).reminders), 1)
+
+    def test_closed_form_until_and_count(self):
+        """until and count are derived without expanding the whole rule."""
+        for frequency, byday in (('daily', ''), ('weekly', ''), ('weekly', 'TU,TH'),
+                                 ('monthly', ''), ('yearly', '')):
+            self.recurrence.byday = byday
+            self.recurrence.frequency = frequency
+            self.recurrence.count = 40
+            rule = self.recurrence.build_rrule()
+            self.assertEqual(self.recurrence.until, list(rule)[-1])
+            self.recurrence.until = self.dtstart + timedelta(days=1000)
+            rule = self.recurrence.build_rrule(until=self.recurrence.until)
+            self.assertEqual(self.recurrence.count, len(list(rule)))
+            self.recurrence.count = None
+
+    def test_inherited_values(self):
+        """Unmodified Occurrences follow the master's cells."""
+        self.recurrence.frequency = 'daily'
+        self.item.title = u'Standup'
+        first = self.recurrence.get_occurrence(self.dtstart)
+        second = self.recurrence.get_occurrence(self.dtstart + timedelta(days=1))
+        self.assertEqual(first.title, u'Standup')
+        self.assertEqual(Event(second).base_start, self.dtstart + timedelta(days=1))
+        self.assertEqual(Event(second).location, None)
+        first.modify(None, 'title', u'Retrospective')
+        self.event.location = u'Lobby'
+        self.item.title = u'Daily standup'
+        self.assertEqual(first.title, u'Retrospective')
+        self.assertEqual(second.title, u'Daily standup')
+        self.assertEqual(Event(first).location, u'Lobby')
+        first.remove_change(None, 'title')
+        self.assertEqual(first.title, u'Daily standup')
+
+    def test_inherited_cells_kept(self):
+        """The table of inherited cells is kept between lookups."""
+        self.recurrence.frequency = 'daily'
+        occurrence = self.recurrence.get_occurrence(self.dtstart)
+        occurrence.title
+        table = self.recurrence._inherited_cells()
+        self.assert_((None, 'title') in table)
+        occurrence.title
+        self.assert_(self.recurrence._inherited_cells() is table)
+        self.recurrence.recurrence_id_override = 'start'
+        self.failIf(self.recurrence._inherited_cells() is table)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,44 @@
+"""Measure the memory used by bulk-created items"""
+
+import sys, subprocess
+
+# Each measurement runs in a fresh interpreter, so the items measured
+# first don't leave a larger heap behind for the ones measured after them
+MEASURE = """
+import resource
+from chandler import core
+def peak_size():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+before = peak_size()
+if %(lazy)r:
+    with_lazy_addons = core.LazyAddOns.lazily()
+    with_lazy_addons.__enter__()
+items = [core.%(class_name)s(title=u'Item %%d' %% i) for i in xrange(%(count)d)]
+print peak_size() - before
+"""
+
+VARIANTS = (
+    ('Item', False),
+    ('ColdItem', False),
+    ('ColdItem', True),
+)
+
+def measure(class_name, count, lazy=False):
+    """
+    Return how much the peak resident size of a new interpreter grows, in
+    kilobytes, while it creates count instances of a chandler.core class.
+    """
+    script = MEASURE % dict(class_name=class_name, count=count, lazy=lazy)
+    output = subprocess.Popen([sys.executable, '-c', script],
+                              stdout=subprocess.PIPE).communicate()[0]
+    return int(output)
+
+def memory_main():
+    """Print the memory used by Items and ColdItems, 100000 by default"""
+    count = int((sys.argv[1:] or [100000])[0])
+    print "%d items created" % count
+    for class_name, lazy in VARIANTS:
+        size = measure(class_name, count, lazy)
+        label = class_name + (lazy and ", lazy add-ons" or "")
+        print "%-24s %10d kB %8.0f bytes/item" % (label, size,
+                                                  size * 1024.0 / count)
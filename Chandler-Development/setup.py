@@ -34,5 +34,6 @@ setup(
     PyCrust = chandler.debug.py_crust:LaunchPyCrust
     [console_scripts]
     chandler-debug = chandler.debug.py_crust:debug_main
+    chandler-memory = chandler.debug.memory:memory_main
     """
 ),
@@ -1,16 +1,22 @@
 import peak.events.trellis as trellis
 import peak.events.collections as collections
 import peak.events.activity as activity
+import peak.context as context
 from simplegeneric import generic
 from peak.util import addons, plugins
 from datetime import datetime
 import chandler.time_services as time_services
 import time
 import sys
-
-__all__ = ('Item', 'Extension', 'DashboardEntry', 'Collection', 'Entity',
-           'One', 'Many', 'FilteredSubset', 'AggregatedSet',
-           'ItemAddOn', 'inherited_attrs', 'reset_cell_default',
+import contextlib
+import weakref
+import pkg_resources
+
+__all__ = ('Item', 'ColdItem', 'ColdRecord', 'Extension', 'DashboardEntry', 'Collection', 'Entity',
+           'One', 'Many', 'FilteredSubset', 'IndexedSubset', 'AggregatedSet',
+           'ExtensionIndex', 'LazyAddOns',
+           'ItemAddOn', 'inherited_attrs', 'reset_cell_default', 'untracked',
+           'register_hook',
            'InteractionComponent', 'Feature', 'Scope',
            'Command', 'Text', 'Table', 'TableColumn', 'Choice', 'ChoiceItem',
            'ConstraintError',)
@@ -150,6 +156,17 @@ class TupleBackedSet(trellis.Set):
             trellis.Set.add(self, obj)
 
 
+class WeakSet(trellis.Set):
+    """
+    trellis.Set subclass that doesn't keep its members alive.  A member
+    that's garbage collected just disappears; nothing is removed, so no
+    rule is recalculated.
+    """
+
+    _data = trellis.maintain(trellis.Set._data.rule,
+                             make=weakref.WeakKeyDictionary)
+
+
 class AggregatedSet(trellis.sets.ImmutableSet, trellis.Component):
     """
     Takes a Set of input objects, and a get_values() function, and
@@ -326,12 +343,222 @@ class FilteredSubset(AggregatedSet):
     def get_values(self, item):
         return (item,) if self.predicate(item) else ()
 
+class IndexedSubset(trellis.sets.ImmutableSet, trellis.Component):
+    """
+    The members of ``input`` that have ``extension`` installed, or all of
+    ``input`` if ``extension`` is None.
+
+    Unlike FilteredSubset, nothing is evaluated per item: membership is
+    the intersection of ``input`` with the ExtensionIndex set for
+    ``extension``, and is updated from the added and removed cells of
+    both.
+    """
+
+    extension = trellis.attr(None)
+
+    def __init__(self, iterable=None, **kw):
+        if iterable is not None:
+            kw.update(input=trellis.Set(iterable))
+        trellis.Component.__init__(self, **kw)
+
+    @trellis.maintain
+    def input(self):
+        return trellis.Set()
+
+    _added = trellis.todo(set)
+    _removed = trellis.todo(set)
+    added, removed = _added, _removed
+    to_add = _added.future
+    to_remove = _removed.future
+
+    @trellis.compute(resetting_to=None)
+    def _new_input(self):
+        return self.input
+
+    @trellis.compute(resetting_to=None)
+    def _new_extension(self):
+        return (self.extension,)
+
+    @trellis.compute
+    def _index(self):
+        if self.extension is not None:
+            return ExtensionIndex.items_with(self.extension)
+
+    @trellis.maintain(make=set)
+    def _inputs(self):
+        """A plain set of the members of input, for fast intersections."""
+        inputs = self._inputs
+        if self._new_input is not None:
+            trellis.on_undo(inputs.update, set(inputs))
+            inputs.clear()
+            inputs.update(self._new_input)
+            trellis.mark_dirty()
+        else:
+            for item in self.input.removed:
+                if item in inputs:
+                    inputs.remove(item)
+                    trellis.on_undo(inputs.add, item)
+                    trellis.mark_dirty()
+            for item in self.input.added:
+                if item not in inputs:
+                    inputs.add(item)
+                    trellis.on_undo(inputs.discard, item)
+                    trellis.mark_dirty()
+        return inputs
+
+    @trellis.maintain(make=dict)
+    def _data(self):
+        """The dictionary containing the subset's members."""
+        data = self._data
+        inputs = self._inputs
+        index = self._index
+        new_input, new_extension = self._new_input, self._new_extension
+        if new_input is not None or new_extension is not None:
+            if index is None:
+                wanted = inputs
+            else:
+                wanted = inputs.intersection(index._data)
+            added = [item for item in wanted if item not in data]
+            removed = [item for item in data if item not in wanted]
+        else:
+            changed = set(self.input.added)
+            changed.update(self.input.removed)
+            if index is not None:
+                changed.update(index.added)
+                changed.update(index.removed)
+            added, removed = [], []
+            for item in changed:
+                wanted = item in inputs and (index is None or item in index)
+                if wanted and item not in data:
+                    added.append(item)
+                elif item in data and not wanted:
+                    removed.append(item)
+
+        for item in removed:
+            del data[item]
+            trellis.on_undo(data.__setitem__, item, True)
+        for item in added:
+            data[item] = True
+            trellis.on_undo(data.pop, item, None)
+        if added or removed:
+            self.to_add.update(added)
+            self.to_remove.update(removed)
+            trellis.mark_dirty()
+        return data
+
 class Entity(trellis.Component):
     _extension_types = trellis.make(trellis.Set)
 
-    @trellis.maintain
-    def extensions(self):
-        return frozenset(t(self) for t in self._extension_types)
+    # The Extensions that have been added, updated by add() and remove()
+    extensions = trellis.make(trellis.Set)
+
+    # extension type -> Value cell, True while it's added
+    _extension_flags = trellis.make(dict)
+
+    def _extension_flag(self, extension_type):
+        flag = self._extension_flags.get(extension_type)
+        if flag is None:
+            flag = self._extension_flags[extension_type] = trellis.Value(False)
+        return flag
+
+    def has_extension(self, extension_type):
+        """Has extension_type been added?
+
+        Rules that call this are only recalculated when extension_type is
+        added or removed, not when other extensions are.
+        """
+        return self._extension_flag(extension_type).value
+
+def untracked(func, *args):
+    """
+    Return func(*args), without making the current rule (if any) depend on
+    the cells it reads.
+    """
+    ctrl = trellis.ctrl
+    listener, ctrl.current_listener = ctrl.current_listener, None
+    try:
+        return func(*args)
+    finally:
+        ctrl.current_listener = listener
+
+_hook_registry_version = 0
+
+def hooks_changed(*args):
+    """
+    Note that hook registrations have changed, so lookups cached by
+    hook_registry_state() are made again.  Call it after registering or
+    removing hooks without register_hook(), e.g. after test teardown
+    restores the registrations.  It's also called for each distribution
+    added to pkg_resources.working_set, since a new distribution's entry
+    points may implement hooks.
+    """
+    global _hook_registry_version
+    _hook_registry_version += 1
+
+pkg_resources.working_set.subscribe(hooks_changed)
+
+def register_hook(hook, ob):
+    """Register ob with hook, a plugins.Hook, and call hooks_changed()."""
+    hook.register(ob)
+    hooks_changed()
+
+def hook_registry_state():
+    """
+    Return a value that changes whenever hooks_changed() is called, for
+    caching what a hook lookup found.
+    """
+    return _hook_registry_version
+
+class LazyAddOns(context.Service):
+    """
+    While enabled is True, AddOn classes registered with an Item or
+    DashboardEntry hook aren't created along with each item or entry.
+    Like any AddOn, they're created the first time they're used instead.
+
+    Registered callables that aren't AddOn classes, and AddOn classes
+    with a true eager_addon attribute, are still called right away.
+
+    Which extensions are eager is looked up again whenever the hook
+    registrations change through register_hook().  Call refresh() after changing eager_addon on
+    an add-on class that's already registered.
+    """
+
+    enabled = False
+
+    def __init__(self):
+        self._eager = {}
+
+    def refresh(self):
+        self._eager.clear()
+
+    @contextlib.contextmanager
+    def lazily(self):
+        """Enable lazy add-ons until the with block exits."""
+        previous, self.enabled = self.enabled, True
+        try:
+            yield
+        finally:
+            self.enabled = previous
+
+    def eager_extensions(self, hook):
+        state = hook_registry_state()
+        cached = self._eager.get(hook)
+        if cached is None or cached[0] != state:
+            cached = self._eager[hook] = state, tuple(
+                extension for extension in hook
+                if not (isinstance(extension, type) and
+                        issubclass(extension, addons.AddOn)) or
+                   getattr(extension, 'eager_addon', False)
+            )
+        return cached[1]
+
+def load_addons(extensible):
+    """Call extensible's hooks, leaving out lazy add-ons if enabled."""
+    if LazyAddOns.enabled:
+        for extension in LazyAddOns.eager_extensions(extensible.extend_with):
+            extension(extensible)
+    else:
+        extensible.load_extensions() # plugins.Extensible method
 
 class Item(Entity, plugins.Extensible):
     extend_with = plugins.Hook('chandler.domain.item_addon')
@@ -355,13 +582,76 @@ class Item(Entity, plugins.Extensible):
 
     def __init__(self, **kwargs):
         trellis.Component.__init__(self, **kwargs)
-        self.load_extensions() # plugins.Extensible method
+        load_addons(self)
 
     def inherited_value(self, add_on_instance, name):
         """Inheritance rule for cells defined by inherited_attrs."""
         return getattr(add_on_instance, name)
 
 
+class ColdRecord(object):
+    """The values of a ColdItem's cells that haven't been created yet"""
+    __slots__ = ('title', 'body', 'created')
+
+class ColdAttribute(trellis.CellAttribute):
+    """
+    An optional copy of one of Item's cell attributes.  The cell is created
+    the first time it's used, starting from the value in the item's
+    ColdRecord.  Until then, setting the attribute just changes the record,
+    since nothing can be observing a cell that doesn't exist.
+    """
+
+    def __init__(self, attribute):
+        self.__dict__.update(attribute.__dict__)
+        self.optional = True
+
+    def initial_value(self, ob):
+        try:
+            return getattr(ob._cold, self.__name__)
+        except AttributeError:
+            return super(ColdAttribute, self).initial_value(ob)
+
+    def __set__(self, ob, value):
+        name = self.__name__
+        if (name in ColdRecord.__slots__
+            and name not in getattr(ob, '__cells__', ())
+            and not isinstance(value, trellis.AbstractCell)):
+            _set_cold(ob._cold, name, value)
+        else:
+            super(ColdAttribute, self).__set__(ob, value)
+
+@trellis.modifier
+def _set_cold(record, name, value):
+    try:
+        trellis.on_undo(setattr, record, name, getattr(record, name))
+    except AttributeError:
+        trellis.on_undo(delattr, record, name)
+    setattr(record, name, value)
+
+class ColdItem(Item):
+    """
+    An Item that doesn't create any cells when it's created.
+
+    title, body and created are kept in a slotted ColdRecord, and their
+    cells, like the one for extensions, are only created the first time
+    they're used.  It's meant for bulk imports of items that are rarely
+    looked at, like archived collections.
+
+    collections is still created along with the item, since its set only
+    follows changes to the memberships table; one created later would miss
+    the memberships added before it.
+    """
+
+    title = ColdAttribute(Item.title)
+    body = ColdAttribute(Item.body)
+    created = ColdAttribute(Item.created)
+
+    def __init__(self, **kwargs):
+        self._cold = ColdRecord()
+        self._cold.created = time_services.nowTimestamp()
+        super(ColdItem, self).__init__(**kwargs)
+
+
 class ItemAddOn(trellis.Component, addons.AddOn):
     _item = trellis.attr(None)
     item = trellis.make(lambda self: self._item, optional=False)
@@ -392,34 +682,65 @@ def get_inherit_rule(name):
     func.__name__ = name
     return func
 
+class ExtensionIndex(context.Service):
+    """
+    For each Extension type, a WeakSet of the Entities it has been added
+    to, kept current by Extension.add() and remove().  The index doesn't
+    keep an Entity alive once nothing else refers to it.
+    """
+
+    def __init__(self):
+        self._sets = {}
+
+    def items_with(self, extension_type):
+        items = self._sets.get(extension_type)
+        if items is None:
+            items = self._sets[extension_type] = WeakSet()
+        return items
+
 class Extension(ItemAddOn):
     @trellis.modifier
     def add(self, **kw):
         t = type(self)
+        item = self.item
 
-        if t in self.item._extension_types:
+        flag = item._extension_flag(t)
+        if flag.value:
             raise ValueError("Extension %s has already been added" % (t,))
 
-        self.item._extension_types.add(t)
+        flag.value = True
+        item._extension_types.add(t)
+        item.extensions.add(self)
+        ExtensionIndex.items_with(t).add(item)
         trellis.init_attrs(self, **kw)
         return self
 
     @trellis.modifier
     def remove(self):
         t = type(self)
+        item = self.item
 
-        try:
-            self.item._extension_types.remove(t)
-        except KeyError:
+        flag = item._extension_flag(t)
+        if not flag.value:
             raise ValueError("Extension %s is not present" % (t,))
 
+        flag.value = False
+        item._extension_types.remove(t)
+        item.extensions.discard(self)
+        ExtensionIndex.items_with(t).discard(item)
+
+    @classmethod
+    def installed_items(cls):
+        """The WeakSet of Entities this Extension has been added to."""
+        return ExtensionIndex.items_with(cls)
+
     @classmethod
     def installed_on(cls, obj):
         try:
             obj = obj._item
         except AttributeError:
             pass
-        return isinstance(obj, Entity) and cls in obj._extension_types
+        return isinstance(obj, Entity) and obj.has_extension(cls)
 
 class DashboardEntry(trellis.Component, plugins.Extensible):
     extend_with = plugins.Hook('chandler.domain.dashboard_entry_addon')
@@ -433,14 +754,16 @@ class DashboardEntry(trellis.Component, plugins.Extensible):
     def __init__(self, subject_item, **kw):
         if not isinstance(subject_item, Item):
             raise TypeError, "DashboardEntry's subject_item must be an Item"
-        cells = trellis.Cells(subject_item)
-        # touch created in case it's a rule and doesn't yet exist
+        # touch created and title in case they're rules or optional cells
+        # (as on a ColdItem) that don't yet exist
         subject_item.created
+        subject_item.title
+        cells = trellis.Cells(subject_item)
         kw.setdefault("when", cells["created"])
         kw.setdefault("what", cells["title"])
         super(DashboardEntry, self).__init__(**kw)
         self.subject_item = subject_item
-        self.load_extensions() # plugins.Extensible methods
+        load_addons(self)
 
 
 class Collection(Entity):
@@ -18,7 +18,7 @@ __all__ = [
     'add_converter', 'subtype', 'typedef', 'field', 'key', 'NoChange',
     'Record', 'RecordSet', 'Diff', 'lookupSchemaURI', 'Filter', 'Translator',
     'exporter', 'TimestampType', 'IncompatibleTypes', 'Inherit',
-    'sort_records', 'format_field', 'global_formatters',
+    'sort_records', 'format_field', 'global_formatters', 'RecordCache',
 ]
 
 from peak.util.symbols import Symbol, NOT_GIVEN
@@ -30,8 +30,9 @@ import logging
 logger = logging.getLogger(__name__)
 
 from chandler.core import (Entity, Item, Collection, ItemAddOn,
-                           Extension, reset_cell_default)
+                           Extension, reset_cell_default, untracked)
 import peak.events.trellis as trellis
+from peak.util import addons
 from uuid import UUID, uuid4
 import traceback
 
@@ -77,11 +78,18 @@ def get_for_name_or_uuid(name_or_uuid):
         return named
     return get_item_for_uuid(name_or_uuid)
 
-def item_for_uuid(uuid):
-    """Return existing Item, or create and return a new Item."""
+@trellis.modifier
+def add_eim(items):
+    """Add EIM to each of items that doesn't have it yet, in one modifier"""
+    for item in items:
+        if not EIM.installed_on(item):
+            EIM(item).add()
+
+def item_for_uuid(uuid, item_class=Item):
+    """Return existing Item, or create and return a new item_class."""
     item = get_item_for_uuid(uuid)
     if not item:
-        item = Item()
+        item = item_class()
         EIM(item).add(uuid=UUID(uuid))
     return item
 
@@ -958,9 +966,50 @@ class TranslatorClass(type):
         return cls
 
 
+class RecordCache(addons.AddOn):
+    """The records a kind of Translator last exported for an item.
+
+    Nothing watches the item for changes.  Instead, the records are stamped
+    with the trellis pulse they were exported in, and exported again when
+    they're read in a later pulse.  They're also exported again when read
+    from inside a rule, which has to depend on the cells the exporters
+    read.  ``version`` is incremented whenever the records exported again
+    differ from the last ones.
+    """
+
+    version = 0
+    _pulse = _records = None
+
+    def __init__(self, subject, key):
+        self.subject = subject
+
+    def records(self, translator):
+        pulse = untracked(getattr, trellis.ctrl.pulse, 'value')
+        if (self._records is None or pulse != self._pulse
+            or trellis.ctrl.current_listener is not None):
+            records = tuple(translator.export_records(self.subject))
+            if trellis.ctrl.active:
+                trellis.on_undo(self._restore, self._records, self._pulse,
+                                self.version)
+            if records != self._records:
+                self.version += 1
+            self._restore(records, pulse, self.version)
+        return self._records
+
+    def _restore(self, records, pulse, version):
+        self._records, self._pulse, self.version = records, pulse, version
+
+
 class Translator:
     """Base class for import/export between Items and Records"""
     __metaclass__ = TranslatorClass
+
+    # Set to True to reuse each item's records until its cells change
+    record_cache = False
+
+    # The class of items created by imports, e.g. ColdItem for bulk loads
+    item_class = Item
+
     def __init__(self):
         self.loadQueue = {}
         self.export_cache = {}
@@ -1009,6 +1058,16 @@ class Translator:
 
     def exportItem(self, item):
         """Export an item and its stamps, if any"""
+        if self.record_cache:
+            return iter(RecordCache(item, self.cache_key()).records(self))
+        return self.export_records(item)
+
+    def cache_key(self):
+        """Translators with equal keys export the same records for an item"""
+        return type(self)
+
+    def export_records(self, item):
+        """Run the exporters for an item and its stamps"""
 
         for item, skipType in self._exportablesFor(item):
 
@@ -1041,7 +1100,7 @@ class Translator:
             yield "Deleted", r.getKey(), Diff([], [r])
 
     def withItemForUUID(self, uuid, itype=Item, **attrs):
-        item = item_for_uuid(uuid)
+        item = item_for_uuid(uuid, self.item_class)
 
         @trellis.modifier
         def setattrs(ob):
@@ -3,6 +3,7 @@ from peak.events import activity
 from peak.util import plugins
 from copy import deepcopy
 from peak import context
+from chandler.core import hooks_changed
 
 import pkg_resources
 from setuptools.command.test import ScanningLoader
@@ -16,6 +17,7 @@ def setUp(test_case):
 def tearDown(test_case):
     test_case.empty_context.__exit__(None, None, None)
     plugins._implementations = test_case._implementations
+    hooks_changed()
 
 # silence annoying logger warnings
 import logging
@@ -17,13 +17,18 @@ import peak.events.activity as activity
 import peak.context as context
 
 from calendar import timegm
-from datetime import datetime, date, time
+from math import ceil
+import heapq
+from datetime import datetime, date, time, timedelta
+from bisect import bisect_right
 import PyICU
 from PyICU import ICUtzinfo
 import dateutil
+from vobject.icalendar import getTransition, tzinfo_eq
 
 __all__ = ('getNow', 'timestamp', 'setNow', 'resetNow', 'nowTimestamp',
-           'TimeZone', 'Scheduled', 'is_past_timestamp', 'is_past',
+           'TimeZone', 'Scheduled', 'TimerWheel', 'Today', 'DateFormatter',
+           'is_past_timestamp', 'is_past',
            'fromtimestamp',
            'force_datetime', 'olsonize', )
 
@@ -70,7 +75,7 @@ def nowTimestamp():
     return activity.Time._now
 
 def is_past_timestamp(stamp):
-    return bool(activity.Time[stamp - nowTimestamp()])
+    return TimerWheel.reached(stamp)
 
 def is_past(dt):
     return is_past_timestamp(timestamp(dt))
@@ -87,10 +92,10 @@ class TimeZone(trellis.Component, context.Service):
         def __init__(self): pass
 
         def utcoffset(self, dt):
-            return TimeZone.default.utcoffset(dt)
+            return _floating_offsets(TimeZone.default, dt)[0]
 
         def dst(self, dt):
-            return TimeZone.default.dst(dt)
+            return _floating_offsets(TimeZone.default, dt)[1]
 
         def __repr__(self):
             return "FloatingTZ(%r)" % (TimeZone.default,)
@@ -98,11 +103,7 @@ class TimeZone(trellis.Component, context.Service):
     floating = _FloatingTZInfo()
 
     def __getitem__(self, key):
-        result = ICUtzinfo.getInstance(key)
-        if result.tzid == 'GMT' and key != 'GMT':
-            return None
-        else:
-            return result
+        return getICUInstance(key)
 
 
     ### Helper constants
@@ -111,6 +112,168 @@ class TimeZone(trellis.Component, context.Service):
     utc      = ICUtzinfo.getInstance("UTC")
 
 
+class TimerWheel(trellis.Component, context.Service):
+    """
+    Coalesce the timers used by Scheduled, reminders and is_past checks.
+
+    Deadlines are rounded up to slots ``resolution`` seconds wide.  Every
+    rule waiting on a deadline in a given slot shares a single cell, and
+    only the earliest pending slot is registered with ``activity.Time``,
+    so the event loop sees one next deadline however many timers are
+    pending.
+    """
+
+    resolution = 1.0
+
+    _schedule = trellis.make(list, writable=True)
+    _slots = trellis.cellcache(lambda self, slot: False)
+
+    _slots.connector()
+    def _add_slot(self, slot):
+        # this heappush doesn't need an undo, since _updated() ignores extras
+        heapq.heappush(self._schedule, slot)
+        trellis.changed(trellis.Cells(self)['_schedule'])
+
+    _slots.disconnector()
+    def _del_slot(self, slot):
+        pass
+
+    @trellis.maintain
+    def _updated(self):
+        schedule = self._schedule
+        now = nowTimestamp()
+        while schedule and self.slot_time(schedule[0]) <= now:
+            slot = heapq.heappop(schedule)
+            trellis.on_undo(heapq.heappush, schedule, slot)
+            if slot in self._slots:
+                self._slots[slot].receive(True)
+        if schedule:
+            # recalculate when the next slot is reached
+            bool(activity.Time[self.slot_time(schedule[0]) - now])
+
+    def slot_for(self, stamp):
+        return int(ceil(stamp / self.resolution))
+
+    def slot_time(self, slot):
+        return slot * self.resolution
+
+    def reached(self, stamp):
+        """
+        Return True if stamp is in the past.
+
+        When called from a rule, the rule will be recalculated once stamp's
+        slot is reached.
+        """
+        if stamp <= nowTimestamp():
+            return True
+        elif trellis.ctrl.current_listener is None:
+            return False
+        return self._slots[self.slot_for(stamp)].value
+
+    def next_deadline(self):
+        """The timestamp of the earliest pending slot, or None."""
+        if self._schedule:
+            return self.slot_time(self._schedule[0])
+
+
+class Today(trellis.Component, context.Service):
+    """
+    The current date in TimeZone.default.
+
+    Cells depending on Today are recalculated once per local day, at
+    midnight (or when TimeZone.default changes), rather than every time
+    Time advances.
+    """
+
+    @trellis.compute
+    def _day(self):
+        tz = TimeZone.default
+        today = getNow(tz).date()
+        boundaries = tuple(
+            timestamp(datetime.combine(today + timedelta(days=offset),
+                                       time(0, tzinfo=tz)))
+            for offset in (-1, 0, 1, 2)
+        )
+        # recalculate at midnight
+        TimerWheel.reached(boundaries[2])
+        return today, boundaries
+
+    @trellis.compute
+    def date(self):
+        return self._day[0]
+
+    @trellis.compute
+    def boundaries(self):
+        """
+        Timestamps of the start of yesterday, today, tomorrow and the day
+        after tomorrow.
+        """
+        return self._day[1]
+
+    def days_from_today(self, stamp):
+        """
+        Return -1, 0 or 1 if stamp falls yesterday, today or tomorrow,
+        otherwise None.
+        """
+        boundaries = self.boundaries
+        if boundaries[0] <= stamp < boundaries[-1]:
+            return bisect_right(boundaries, stamp) - 2
+
+
+# (locale name, tzid) -> (date format, time format)
+_date_formats = {}
+
+def _formats_for(locale, tzinfo):
+    key = locale.getName(), tzinfo.tzid
+    formats = _date_formats.get(key)
+    if formats is None:
+        icu_timezone = PyICU.TimeZone.createTimeZone(tzinfo.tzid)
+        date_format = PyICU.DateFormat.createDateInstance(
+                          PyICU.DateFormat.kShort, locale)
+        time_format = PyICU.DateFormat.createTimeInstance(
+                          PyICU.DateFormat.kShort, locale)
+        date_format.setTimeZone(icu_timezone)
+        time_format.setTimeZone(icu_timezone)
+        formats = _date_formats[key] = date_format, time_format
+    return formats
+
+class DateFormatter(trellis.Component, context.Service):
+    """
+    Format datetimes for display in TimeZone.default, using PyICU.
+
+    Formatted strings are remembered by local date and minute, so
+    displaying many datetimes close to each other only formats each
+    minute once.
+    """
+
+    locale = trellis.attr(None)
+    memo_size = 10000
+
+    @trellis.compute
+    def _formats(self):
+        locale = self.locale or PyICU.Locale.getDefault()
+        tz = TimeZone.default
+        # the memo is replaced whenever the locale or timezone change
+        return tz, _formats_for(locale, tz), {}
+
+    def format(self, dt, is_day=False):
+        """
+        Return a (date, time) tuple of strings for dt. The time string is
+        empty if is_day is True.
+        """
+        tz, (date_format, time_format), memo = self._formats
+        local = dt.astimezone(tz)
+        key = local.date(), local.hour * 60 + local.minute, is_day
+        result = memo.get(key)
+        if result is None:
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            udate = timestamp(local) * 1000.0
+            time_part = time_format.format(udate) if not is_day else u""
+            result = memo[key] = date_format.format(udate), time_part
+        return result
+
+
 class Scheduled(trellis.Component):
 
     fire_date = trellis.attr(datetime.min.replace(tzinfo=TimeZone.floating))
@@ -118,12 +281,12 @@ class Scheduled(trellis.Component):
 
     @trellis.compute
     def _when_to_fire(self):
-        # We want to convert fire_date into an activity.Time object.
-        # To do that, subtract from datetime.now
-        delta_seconds = timestamp(self.fire_date) - nowTimestamp()
+        # Setting fire_date into the past never fires, otherwise wait for
+        # TimerWheel to reach fire_date
+        stamp = timestamp(self.fire_date)
 
-        if delta_seconds >= 0:
-            return activity.Time[delta_seconds]
+        if stamp >= nowTimestamp():
+            return TimerWheel.reached(stamp)
         else:
             return False
 
@@ -140,18 +303,172 @@ tzid_mapping = {}
 # timezone database
 olson_tzids = tuple(PyICU.TimeZone.createEnumeration())
 
+# tzid -> ICUtzinfo (or None, for unknown tzids)
+_icu_instances = {}
+
 def getICUInstance(name):
     """Return an ICUInstance, or None for false positive GMT results."""
-    result = None
-    if name is not None:
-        result = ICUtzinfo.getInstance(name)
-        if result is not None and \
-            result.tzid == 'GMT' and \
-            name != 'GMT':
-            result = None
-
+    if name is None:
+        return None
+    try:
+        return _icu_instances[name]
+    except KeyError:
+        pass
+
+    result = ICUtzinfo.getInstance(name)
+    if result is not None and \
+        result.tzid == 'GMT' and \
+        name != 'GMT':
+        result = None
+
+    _icu_instances[name] = result
     return result
 
+# Offset tables are only built for years in this range, anything else is
+# rare enough to leave to PyICU
+_TABLE_YEARS = (1900, 2100)
+
+def _offsets(tzinfo, dt):
+    return tzinfo.utcoffset(dt), tzinfo.dst(dt)
+
+def _build_offset_table(tzinfo, year):
+    """
+    Return a (starts, values) pair describing tzinfo during year.
+
+    starts is a sorted list of naive local datetimes, accurate to the
+    minute, at which tzinfo's (utcoffset, dst) changes to the
+    corresponding element of values.  Offsets are sampled every week, and
+    each change found is searched for, along with any others after it in
+    the same week.  Only a change that's reversed within a week, which no
+    zone does, is missed.
+    """
+    first, last = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    bounds = [first + timedelta(weeks=week)
+              for week in xrange((last - first).days // 7 + 1)]
+    bounds.append(last)
+    starts = [first]
+    values = [_offsets(tzinfo, first)]
+    for low, high in zip(bounds, bounds[1:]):
+        while _offsets(tzinfo, high) != values[-1]:
+            # binary search for the first minute with a different value
+            span = high - low
+            low_minute, high_minute = 0, span.days * 1440 + span.seconds // 60
+            while high_minute - low_minute > 1:
+                middle = (low_minute + high_minute) // 2
+                if _offsets(tzinfo, low + timedelta(minutes=middle)) == values[-1]:
+                    low_minute = middle
+                else:
+                    high_minute = middle
+            low = low + timedelta(minutes=high_minute)
+            starts.append(low)
+            values.append(_offsets(tzinfo, low))
+    return starts, values
+
+# (tzid, year) -> offset table
+_offset_tables = {}
+
+def _table_for(tzinfo, year):
+    key = tzinfo.tzid, year
+    table = _offset_tables.get(key)
+    if table is None:
+        table = _offset_tables[key] = _build_offset_table(tzinfo, year)
+    return table
+
+# Offset tables for the default timezone, keyed by year.  The first element
+# is the default timezone the tables belong to; when TimeZone.default
+# changes, they're discarded.
+_floating_tables = [None, {}]
+
+def _floating_offsets(default, dt):
+    """Return (utcoffset, dst) for dt in the default timezone."""
+    if dt is None or not _TABLE_YEARS[0] <= dt.year <= _TABLE_YEARS[1]:
+        return _offsets(default, dt)
+    if _floating_tables[0] is not default:
+        _floating_tables[:] = [default, {}]
+    tables = _floating_tables[1]
+    table = tables.get(dt.year)
+    if table is None:
+        table = tables[dt.year] = _table_for(default, dt.year)
+    starts, values = table
+    return values[bisect_right(starts, dt.replace(tzinfo=None)) - 1]
+
+def _transition_signature(tzinfo, year_start, year_end):
+    """
+    Return a hashable summary of tzinfo's offsets and DST transitions.
+
+    Two tzinfos have equal signatures exactly when
+    vobject.icalendar.tzinfo_eq considers them equal for the given years.
+    """
+    def offset(dt):
+        return None if dt is None else tzinfo.utcoffset(dt)
+
+    signature = [offset(datetime(year_start, 1, 1))]
+    for year in xrange(year_start, year_end):
+        for transition_to in 'daylight', 'standard':
+            dt = getTransition(transition_to, year, tzinfo)
+            signature.append((dt, offset(dt)))
+    return tuple(signature)
+
+_olson_indexes = {}
+
+def _olson_index(year_start, year_end):
+    """
+    Return a dictionary mapping transition signatures to Olson ICUtzinfos.
+
+    The index is built the first time a given range of years is needed.
+    When several timezones share a signature, the first one in olson_tzids
+    wins, and timezones in Antarctica are skipped; when we're guessing we
+    might as well choose a location with human population > 100.
+    """
+    key = year_start, year_end
+    index = _olson_indexes.get(key)
+    if index is None:
+        index = {}
+        for tzid in olson_tzids:
+            if tzid.startswith('Antarctica'):
+                continue
+            test_tzinfo = getICUInstance(tzid)
+            if test_tzinfo is not None:
+                signature = _transition_signature(test_tzinfo, year_start,
+                                                  year_end)
+                index.setdefault(signature, test_tzinfo)
+        _olson_indexes[key] = index
+    return index
+
+# (year, transition signature) -> ICUtzinfo or None, for tzinfos we've
+# already tried to match against the Olson database
+_signature_mapping = {}
+
+def _match_olson(oldTzinfo, year_start, year_end):
+    """Return the Olson ICUtzinfo matching oldTzinfo's transitions, or None."""
+    signature = _transition_signature(oldTzinfo, year_start, year_end)
+    key = year_start, signature
+    if key in _signature_mapping:
+        return _signature_mapping[key]
+
+    # only test for the DST transitions for the year of the event being
+    # converted.  This could be very wrong, but sadly it's legal (and
+    # common practice) to serialize VTIMEZONEs with only one year's DST
+    # transitions in it.  Some clients (notably iCal) won't even bother
+    # to get that year's offset transitions right, but in that case, we
+    # really can't pin down a timezone definitively anyway (fortunately
+    # iCal uses standard zoneinfo tzid strings, so getICUInstance should
+    # just work)
+    result = _olson_index(year_start, year_end).get(signature)
+
+    if result is None:
+        # sadly, with the advent of the new US timezones, Exchange has
+        # chosen to serialize US timezone DST transitions as if they began
+        # in 1601, so we can't rely on dt.year.  So also try 2007-2008, but
+        # only as a fallback, since the VTIMEZONE may not define DST
+        # transitions for 2007-2008.  There's no way to distinguish
+        # between, say, America/Detroit and America/New_York in the 21st
+        # century, so the first match in olson_tzids is used.
+        backup_signature = _transition_signature(oldTzinfo, 2007, 2008)
+        result = _olson_index(2007, 2008).get(backup_signature)
+
+    _signature_mapping[key] = result
+    return result
 
 def olsonize(oldTzinfo, dt=None):
     """Turn oldTzinfo into an ICUtzinfo whose tzid matches something in the Olson db.
@@ -172,65 +489,23 @@ def olsonize(oldTzinfo, dt=None):
         # works for now. This means that we're preferring
         # a tz like 'America/Chicago' over 'CST' or 'CDT'.
         tzical_tzid = getattr(oldTzinfo, '_tzid', None)
-        icuTzinfo = getICUInstance(tzical_tzid)
-
-        if tzical_tzid is not None:
-            if tzical_tzid in tzid_mapping:
-                # we've already calculated a tzinfo for this tzid
-                icuTzinfo = tzid_mapping[tzical_tzid]
+        if tzical_tzid in tzid_mapping:
+            # we've already calculated a tzinfo for this tzid
+            icuTzinfo = tzid_mapping[tzical_tzid]
+        else:
+            icuTzinfo = getICUInstance(tzical_tzid)
 
         if icuTzinfo is None:
             # special case UTC, because dateutil.tz.tzutc() doesn't have a TZID
             # and a VTIMEZONE isn't used for UTC
-            if vobject.icalendar.tzinfo_eq(TimeZone.utc, oldTzinfo):
+            if tzinfo_eq(TimeZone.utc, oldTzinfo):
                 icuTzinfo = TimeZone.utc
 
-        # iterate over all PyICU timezones, return the first one whose
-        # offsets and DST transitions match oldTzinfo.  This is painfully
-        # inefficient, but we should do it only once per unrecognized timezone,
-        # so optimization seems premature.
-        backup = None
+        # look up a PyICU timezone whose offsets and DST transitions match
+        # oldTzinfo; tzinfos without a tzid are remembered by signature
         if icuTzinfo is None:
-            well_known = [] # XXX replace view-based well-known timezones with something else
-            # canonicalTimeZone doesn't help us here, because our matching
-            # criteria aren't as strict as PyICU's, so iterate over well known
-            # timezones first
-            for tzid in itertools.chain(well_known, olson_tzids):
-                test_tzinfo = getICUInstance(tzid)
-                # only test for the DST transitions for the year of the event
-                # being converted.  This could be very wrong, but sadly it's
-                # legal (and common practice) to serialize VTIMEZONEs with only
-                # one year's DST transitions in it.  Some clients (notably iCal)
-                # won't even bother to get that year's offset transitions right,
-                # but in that case, we really can't pin down a timezone
-                # definitively anyway (fortunately iCal uses standard zoneinfo
-                # tzid strings, so getICUInstance above should just work)
-                #
-                # Also, don't choose timezones in Antarctica, when we're guessing
-                # we might as well choose a location with human population > 100.
-                if (not tzid.startswith('Antarctica') and
-                    vobject.icalendar.tzinfo_eq(test_tzinfo, oldTzinfo,
-                                               year_start, year_end)):
-                    icuTzinfo = test_tzinfo
-                    if tzical_tzid is not None:
-                        tzid_mapping[tzical_tzid] = icuTzinfo
-                    break
-                # sadly, with the advent of the new US timezones, Exchange has
-                # chosen to serialize US timezone DST transitions as if they
-                # began in 1601, so we can't rely on dt.year.  So also try
-                # 2007-2008, but treat any matches as a backup, they're
-                # less reliable, since the VTIMEZONE may not define DST
-                # transitions for 2007-2008.  Keep the first match, since we
-                # process well known timezones first, and there's no way to
-                # distinguish between, say, America/Detroit and America/New_York
-                # in the 21st century.
-                if backup is None:
-                    if vobject.icalendar.tzinfo_eq(test_tzinfo, oldTzinfo,
-                                                   2007, 2008):
-                        backup = test_tzinfo
-        if icuTzinfo is None and backup is not None:
-            icuTzinfo = backup
-            if tzical_tzid is not None:
+            icuTzinfo = _match_olson(oldTzinfo, year_start, year_end)
+            if icuTzinfo is not None and tzical_tzid is not None:
                 tzid_mapping[tzical_tzid] = icuTzinfo
     # if we have an unknown timezone, we'll return floating
     return TimeZone.floating if icuTzinfo is None else icuTzinfo
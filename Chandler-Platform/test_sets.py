@@ -2,6 +2,7 @@ from __future__ import with_statement
 import peak.events.trellis as trellis
 import chandler.core as core
 import unittest
+import weakref, gc
 
 class Component(trellis.Component):
     value = trellis.attr(None)
@@ -350,5 +351,30 @@ class ComputedSetTestCase(unittest.TestCase):
         self.failUnlessEqual(len(union), 0)
 
 
+class Tag(core.Extension):
+    pass
+
+class ExtensionIndexTestCase(unittest.TestCase):
+
+    def testCollected(self):
+        """The index doesn't keep items alive"""
+        kept, dropped = core.Item(), core.Item()
+        Tag(kept).add()
+        Tag(dropped).add()
+        dropped = weakref.ref(dropped)
+        gc.collect()
+        self.failUnless(dropped() is None)
+        self.failUnlessEqual(list(Tag.installed_items()), [kept])
+
+    def testSubsetOfCollected(self):
+        kept = core.Item()
+        Tag(kept).add()
+        Tag(core.Item()).add()
+        gc.collect()
+        subset = core.IndexedSubset([kept], extension=Tag)
+        self.failUnlessEqual(list(subset), [kept])
+        self.failUnlessEqual(len(Tag.installed_items()), 1)
+
+
 if __name__ == "__main__":
     unittest.main()